@@ -1,38 +1,69 @@
-import os, re, ahocorasick, pickle, glob, random, copy, shutil, logging, errno, hashlib, gzip
+import os, re, ahocorasick, pickle, glob, random, shutil, logging, errno, hashlib, gzip, struct, threading, mmap, fnmatch, zlib, time, heapq, tempfile
 import pandas as pd
 from pathlib import Path
+from stat import S_ISREG, S_ISDIR, S_ISLNK
+from array import array
 from contextlib import suppress
 from alive_progress import alive_bar
-from itertools import chain
-from collections import defaultdict
+from itertools import chain, islice, groupby
+from collections import defaultdict, namedtuple, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-def findFiles(regex, exclude = [], target_directory=os.getcwd()):
+def findFiles(regex, exclude = [], target_directory = None, threads: int = 1, limit: int = None, maxDepth: int = None):
     """Simple finder for a multiple files
     :param regex: The regex for the files
     :param exclude: list of terms to exclude from the string
-    :return: A list of matching files
+    :param target_directory: The directory to search, defaults to the current directory
+    :param threads: Number of directories to list concurrently, defaults to 1
+    :param limit: Stop after finding this many files, defaults to no limit
+    :param maxDepth: How many levels of subdirectories to descend into, defaults to no limit
+    :return: A generator of matching files
     """    
+    found = (entry.path for entry in _findEntries(regex, exclude, target_directory, threads, maxDepth))
+    return found if limit is None else islice(found, limit)
+
+def _findEntries(regex, exclude = [], target_directory = None, threads: int = 1, maxDepth: int = None):
+    """Walks a directory for files with names matching a regex, as findFiles.
+    :return: A generator of os.DirEntry for the matching files
+    """
     file = re.compile(f".*({regex}).*")
     exclude = [exclude] if type(exclude) == str else exclude
     exclude = set(exclude + ["work",".nextflow",".snakemake"])
-    found = []
-    for dname, dirs, files in os.walk(target_directory):  #this loop though directies recursively 
-        dirs[:] = [d for d in dirs if d not in exclude] # exclude directory if in exclude list 
-        for fname in files:
-            if file.match(fname): found = found + [os.path.join(dname, fname)]
-    return [] if not found else found
-
-def findFile(regex, exclude = [], func = lambda files: max(files, key=os.path.getctime)):
+    target_directory = os.getcwd() if target_directory is None else target_directory
+
+    def scan(path, depth):
+        dirs, files = [], []
+        for entry in _scanDir(path): (dirs if _isDir(entry) else files).append(entry)
+        subdirs = [] if (maxDepth is not None and depth >= maxDepth) else [entry.path for entry in dirs if entry.name not in exclude and not entry.is_symlink()] # exclude directory if in exclude list 
+        return [entry for entry in files if file.match(entry.name)], subdirs
+
+    for entries in _walkTree([target_directory], scan, threads): yield from entries
+
+def findFile(regex, exclude = [], func = None, target_directory = None, threads: int = 1, maxDepth: int = None):
     """Simple finder for a single file
     :param regex: The regex for the file
     :param exclude: list of terms to exclude from the string
-    :param func: function to execute to ensure a single file return. Default: newest file
+    :param func: function to execute to ensure a single file return. Default: newest file, tracked while walking
+    :param target_directory: The directory to search, defaults to the current directory
+    :param threads: Number of directories to list concurrently, defaults to 1
+    :param maxDepth: How many levels of subdirectories to descend into, defaults to no limit
     :return: A single file
     """   
-    found = findFiles(regex, exclude)
-    if not found: return []
-    elif len(found) == 1: return found[0]
-    else: return func(found)
+    entries = _findEntries(regex, exclude, target_directory, threads, maxDepth)
+    if func is not None:
+        found = [entry.path for entry in entries]
+        if not found: return []
+        elif len(found) == 1: return found[0]
+        else: return func(found)
+
+    newest, newestTime = [], None
+    for entry in entries:
+        try:
+            ctime = entry.stat().st_ctime
+        except OSError:
+            continue
+        if newestTime is None or ctime > newestTime: newest, newestTime = entry.path, ctime
+    return newest
 
 def findFiles2(regex, exclude = None):
     """Simple finder for a single file
@@ -44,49 +75,294 @@ def findFiles2(regex, exclude = None):
     return(files)
      
 def generateMLookupDB(dir: str, outDir: str, excludeDirs: list[str] = None):
-    """ Generates a mlocate.db database for indexed searching
+    """ Generates a locate database (a flat file DB with a trigram index) for indexed searching with mlocateFile
     :param dir: The directory to search
     :param outDir: the file to save database to
-    :param excludeDirs: Directories to omit
+    :param excludeDirs: Directories to omit, by path or name
+    :return: The path to the database
     """       
-    updatedb = "updatedb --database-root '" + dir + "' --output '" + outDir + "'"
-    if excludeDirs != None: updatedb = updatedb + ' --prunepaths "' + " ".join(excludeDirs) + '"'
-    os.system(updatedb)
+    return generateFlatFileDB(dir, outDir, overwrite = True, verbose = False, excludeDirs = excludeDirs, trigramIndex = True)
 
 def mlocateFile(file, mLocateDB):
-    import subprocess
-    command = "locate --database '" + mLocateDB + "' --nofollow '" + file + "'"
+    """Finds paths in a database from generateMLookupDB, like locate. Patterns without glob characters match anywhere in the path
+    :param file: The pattern, or a list of patterns to answer in one pass
+    :param mLocateDB: The database generated by generateMLookupDB
+    :return: The newline-terminated matching paths, or None if there are none. A dictionary of pattern to result if given a list
+    """
+    with open(mLocateDB, "rb") as f:
+        if f.read(8) == b"\0mlocate": raise ValueError(f"'{mLocateDB}' is an mlocate database. Regenerate it with generateMLookupDB.")
+
+    patterns = [file] if isinstance(file, str) else list(dict.fromkeys(file))
+    globs = [pattern for pattern in patterns if glob.has_magic(pattern)]
+    literals = [pattern for pattern in patterns if not glob.has_magic(pattern)]
+
+    found = {}
+    if len(literals) == 1:
+        found[literals[0]] = searchFlatFileDB(mLocateDB, searchTerms = literals, caseSensitive = True, verbose = False)
+    elif literals:
+        found.update(batchSearchFlatFileDB(mLocateDB, literals, caseSensitive = True, verbose = False))
+    if len(globs) == 1:
+        found[globs[0]] = searchFlatFileDB(mLocateDB, searchTerms = globs, caseSensitive = True, verbose = False, mode = "glob")
+    elif globs:
+        regexes = {pattern: re.compile(fnmatch.translate(pattern)) for pattern in globs}
+        found.update({pattern: [] for pattern in globs})
+        for path in readFlatFileDB(mLocateDB):
+            for pattern, regex in regexes.items():
+                if regex.match(path): found[pattern].append(path)
+
+    found = {pattern: "".join(path + "\n" for path in found[pattern]) or None for pattern in patterns}
+    return found[file] if isinstance(file, str) else found
+
+def _scanDir(path: str):
+    """Lists a directory, returning nothing if it cannot be read (as os.walk does).
+    :param path: The directory to list
+    :return: A list of os.DirEntry
+    """
     try:
-        return(subprocess.check_output(command, shell=True, text=True))
-    except subprocess.CalledProcessError:
-        return(None)   
+        with os.scandir(path) as it: return list(it)
+    except OSError:
+        return []
 
-def generateFlatFileDB(dir: list[str],  outFile: str = None, overwrite = False, verbose = True):
+def _isDir(entry: os.DirEntry):
+    """Checks if a DirEntry is a directory (following symlinks), treating errors as not a directory."""
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+def _fileExtension(name: str):
+    """Gets the extension of a file name, including a preceding extension for .gz files (e.g. '.fastq.gz')."""
+    root, ext = os.path.splitext(name)
+    if ext == '.gz':
+        root, prev_ext = os.path.splitext(root)
+        ext = prev_ext + ext
+    return ext
+
+def _walkTree(paths: list[str], scan, threads: int = 1):
+    """Walks directory trees, fanning the directory listings out across a bounded thread pool.
+    :param paths: The root directories to walk
+    :param scan: Function taking (directory, depth) and returning (items, subdirectories to descend into)
+    :param threads: The number of directories to list concurrently. 1 walks serially in os.walk order
+    :return: A generator of item lists, one per directory listed
+    """
+    if threads <= 1:
+        stack = [(path, 0) for path in reversed(paths)]
+        while stack:
+            path, depth = stack.pop()
+            items, subdirs = scan(path, depth)
+            yield items
+            stack.extend((subdir, depth + 1) for subdir in reversed(subdirs))
+        return
+
+    executor = ThreadPoolExecutor(max_workers = threads)
+    pending = {executor.submit(scan, path, 0): 0 for path in paths}
+    try:
+        while pending:
+            done, _ = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                depth = pending.pop(future)
+                items, subdirs = future.result()
+                for subdir in subdirs: pending[executor.submit(scan, subdir, depth + 1)] = depth + 1
+                yield items
+    finally:
+        executor.shutdown(wait = False, cancel_futures = True)
+
+def _orderedMap(func, items, threads: int = 8, inFlight: int = None):
+    """Maps a function over an iterable in a thread pool, keeping a bounded number of items in flight.
+    :param func: The function to apply
+    :param items: The items to apply it to. Consumed lazily
+    :param threads: Number of threads
+    :param inFlight: Maximum number of items submitted but not yet yielded, defaults to threads * 4
+    :return: A generator of the results, in input order
+    """
+    if threads <= 1:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(max_workers = threads) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= (inFlight or threads * 4): yield pending.popleft().result()
+        while pending: yield pending.popleft().result()
+
+# Binary flat file DB: a versioned header followed by one record per path (path length, size, mtime, inode, flags, path)
+_DB_MAGIC = b"STDB"
+_DB_VERSION = 1
+_DB_HEADER = struct.Struct("<4sH")
+_DB_RECORD = struct.Struct("<IQdQB")
+DB_FILE, DB_DIR, DB_SYMLINK = 1, 2, 4
+DBRecord = namedtuple("DBRecord", ["path", "size", "mtime", "inode", "flags"])
+
+def _entryToRecord(entry: os.DirEntry):
+    """Converts a DirEntry to a DBRecord using the stat data captured during the walk.
+    :param entry: The DirEntry to convert
+    :return: A DBRecord. Size/mtime are from lstat, flags follow os.path.isfile/isdir/islink
+    """
+    try:
+        stat = entry.stat(follow_symlinks = False)
+        size, mtime = stat.st_size, stat.st_mtime
+    except OSError:
+        size, mtime = 0, 0.0
+    flags = DB_DIR if _isDir(entry) else 0
+    with suppress(OSError):
+        if entry.is_file(): flags |= DB_FILE
+    if entry.is_symlink(): flags |= DB_SYMLINK
+    return DBRecord(entry.path, size, mtime, entry.inode(), flags)
+
+def _writeDBHeader(f):
+    f.write(_DB_HEADER.pack(_DB_MAGIC, _DB_VERSION))
+
+def _writeDBRecord(f, record: DBRecord):
+    path = os.fsencode(record.path)
+    f.write(_DB_RECORD.pack(len(path), record.size, record.mtime, record.inode, record.flags) + path)
+
+def isBinaryDB(db: str):
+    """Checks if a flat file database was written in the binary format.
+    :param db: The path to the flat file database
+    :return: True if binary, False if plain text
+    """
+    with open(db, "rb") as f:
+        return f.read(len(_DB_MAGIC)) == _DB_MAGIC
+
+def readFlatFileDB(db, metadata: bool = False):
+    """Reads a flat file database generated by generateFlatFileDB, in either the text or binary format.
+    :param db: The path to the database, or a list of paths/DBRecords
+    :param metadata: Return DBRecords instead of paths? Text databases have no metadata (None fields)
+    :return: A generator of paths or DBRecords
+    """
+    if not isinstance(db, str):
+        for item in db:
+            if isinstance(item, DBRecord): yield item if metadata else item.path
+            else: yield DBRecord(str(item).strip(), None, None, None, None) if metadata else str(item).strip()
+        return
+
+    if not isBinaryDB(db):
+        with open(db) as f:
+            for line in f:
+                path = line.rstrip("\n")
+                yield DBRecord(path, None, None, None, None) if metadata else path
+        return
+
+    with open(db, "rb") as f:
+        magic, version = _DB_HEADER.unpack(f.read(_DB_HEADER.size))
+        if version != _DB_VERSION: raise ValueError(f"Unsupported DB version {version} in '{db}'.")
+        while (header := f.read(_DB_RECORD.size)):
+            length, size, mtime, inode, flags = _DB_RECORD.unpack(header)
+            path = os.fsdecode(f.read(length))
+            yield DBRecord(path, size, mtime, inode, flags) if metadata else path
+
+def _iterDBOffsets(db: str):
+    """Reads a flat file database file, tracking where each path starts.
+    :param db: The path to the database file
+    :return: A generator of (byte offset, path)
+    """
+    with open(db, "rb") as f:
+        if f.read(len(_DB_MAGIC)) != _DB_MAGIC:
+            f.seek(0)
+            offset = 0
+            for line in f:
+                yield offset, line.rstrip(b"\n").decode()
+                offset += len(line)
+            return
+
+        offset = _DB_HEADER.size
+        f.seek(offset)
+        while (header := f.read(_DB_RECORD.size)):
+            length = _DB_RECORD.unpack(header)[0]
+            yield offset, os.fsdecode(f.read(length))
+            offset += _DB_RECORD.size + length
+
+def _readDBRecordAt(f, offset: int, binary: bool):
+    """Reads the DBRecord starting at a byte offset of an open ('rb') flat file database."""
+    f.seek(offset)
+    if not binary: return DBRecord(f.readline().rstrip(b"\n").decode(), None, None, None, None)
+    length, size, mtime, inode, flags = _DB_RECORD.unpack(f.read(_DB_RECORD.size))
+    return DBRecord(os.fsdecode(f.read(length)), size, mtime, inode, flags)
+
+def writeFlatFileDB(records, outFile: str, binary: bool = None):
+    """Writes paths or DBRecords to a flat file database.
+    :param records: An iterable of paths or DBRecords
+    :param outFile: The output file path
+    :param binary: Write the binary format? Defaults to binary if the first item is a DBRecord with metadata
+    :return: The path to the output DB file
+    """
+    records = iter(records)
+    first = next(records, None)
+    if binary is None: binary = isinstance(first, DBRecord) and first.flags is not None
+    if first is not None: records = chain([first], records)
+    if binary:
+        with open(outFile, "wb") as f:
+            _writeDBHeader(f)
+            for record in records: _writeDBRecord(f, record)
+    else:
+        with open(outFile, "w") as f:
+            for record in records: f.write((record.path if isinstance(record, DBRecord) else record) + "\n")
+    return outFile
+
+def generateFlatFileDB(dir: list[str],  outFile: str = None, overwrite = False, verbose = True, threads: int = 1, followLinks: bool = False, binary: bool = False, update: bool = False, trigramIndex: bool = False, excludeDirs: list[str] = None):
     """Retrieves all files within a specified folder.
     :param dir: Directory(ies) to search
     :param outFile: The output file path
     :param overwrite: Overwrite outFile if it exists
     :param verbose: Show progress bar
-    :return: A list of files, or the path to the output DB file
+    :param threads: Number of directories to list concurrently. Use more on network shares, defaults to 1
+    :param followLinks: Descend into symlinked directories?, defaults to False
+    :param binary: Capture size, mtime, inode and type in the binary DB format?, defaults to False
+    :param update: Refresh an existing outFile, only re-listing directories whose mtime changed?, defaults to False.
+                   Directory mtimes are saved alongside outFile in '<outFile>.dirs'. Metadata of files modified in place (without changing their directory) is not refreshed
+    :param trigramIndex: Also build a trigram index of outFile for searchFlatFileDB (see generateTrigramIndex)?, defaults to False
+    :param excludeDirs: Directories to omit (with their contents), by path or name
+    :return: A list of files (DBRecords if binary), or the path to the output DB file
     """
     # TODO: Parse input dirs and remove any child directories
     paths = [dir] if isinstance(dir, str) else dir
     for path in paths:
         if not os.path.exists(path): raise Exception("Directory '" + path + "' does not exist. Cannot generate database.")
-    if (overwrite == False and outFile is not None and os.path.exists(outFile)): 
+    excludeDirs = set() if excludeDirs is None else {excludeDirs} if isinstance(excludeDirs, str) else set(excludeDirs)
+    excludeDirs = {exclude.rstrip("/") or "/" for exclude in excludeDirs}
+    if (overwrite == False and update == False and outFile is not None and os.path.exists(outFile)): 
         print("DB already exists and overwrite = False. Retrieving existing DB...")
         return outFile
-    out = [] if outFile is None else open(outFile,'w')
 
-    with alive_bar(title="Retrieving files...", unknown="dots_waves", disable = not verbose) as bar: 
-        for root, dirs, files in chain.from_iterable(os.walk(path) for path in paths):
-            for item in files + dirs:           
-                found = os.path.join(root, item)          
-                out.write(found + "\n") if outFile is not None else out.append(found)
-                bar()
-            
+    # Load the previous listing of each directory for an incremental update
+    dirsFile = None if outFile is None else outFile + ".dirs"
+    oldDirs, oldChildren, newDirs = {}, defaultdict(list), {}
+    if (update and outFile is not None and os.path.exists(outFile) and os.path.exists(dirsFile) and isBinaryDB(outFile) == binary):
+        with open(dirsFile, "rb") as f: oldDirs = pickle.load(f)
+        for item in readFlatFileDB(outFile, metadata = binary):
+            oldChildren[os.path.dirname(item.path if binary else item)].append(item)
+
+    dbFile = outFile + ".tmp" if oldDirs else outFile
+    out = [] if outFile is None else open(dbFile, 'wb' if binary else 'w')
+    if binary and outFile is not None: _writeDBHeader(out)
+
+    def scan(path, depth):
+        key = os.path.dirname(os.path.join(path, "")) # Matches os.path.dirname() of the directory's entries
+        with suppress(OSError): newDirs[key] = os.stat(path).st_mtime_ns
+        if key in newDirs and oldDirs.get(key) == newDirs[key]:
+            items = oldChildren.get(key, [])
+            return items, [item for item in (item.path if binary else item for item in items) if item in oldDirs]
+
+        dirs, files = [], []
+        for entry in _scanDir(path): (dirs if _isDir(entry) else files).append(entry)
+        if excludeDirs: dirs = [entry for entry in dirs if entry.name not in excludeDirs and entry.path not in excludeDirs]
+        subdirs = [entry.path for entry in dirs if followLinks or not entry.is_symlink()]
+        entries = files + dirs
+        return ([_entryToRecord(entry) for entry in entries] if binary else [entry.path for entry in entries]), subdirs
 
-    if outFile is not None: out.close()
+    with alive_bar(title="Retrieving files...", unknown="dots_waves", disable = not verbose) as bar: 
+        for entries in _walkTree(paths, scan, threads):
+            if outFile is None: out.extend(entries)
+            elif binary: [_writeDBRecord(out, record) for record in entries]
+            else: out.writelines(path + "\n" for path in entries)
+            bar(len(entries))
+
+    if outFile is not None: 
+        out.close()
+        if dbFile != outFile: os.replace(dbFile, outFile)
+        if update:
+            with open(dirsFile, "wb") as f: pickle.dump(newDirs, f)
+        if trigramIndex: generateTrigramIndex(outFile, verbose = verbose)
     return (out if outFile is None else outFile)
 
 # printFound = lambda nFiles, nFound, speed, end="\r": print("   Parsed {} files and found {} files ({}s)                 ".format(nFiles,nFound,speed),end=end)
@@ -140,91 +416,561 @@ def generateFlatFileDB(dir: list[str],  outFile: str = None, overwrite = False,
 #     if (verbose): printFound(nFiles,nFound,str(round(time.time() - startTime,2)),"\n")
 #     return (out if outFile is None else outFile)
 
-def searchFlatFileDB(db: str = None, outFile: str = None, searchTerms: list[str] = [], includeTerms: list[str] = [], excludeTerms: list[str] = [], caseSensitive = False, verbose = True):
-    """Searches a flat file database. 
+def searchFlatFileDB(db: str = None, outFile: str = None, searchTerms: list[str] = [], includeTerms: list[str] = [], excludeTerms: list[str] = [], caseSensitive = False, verbose = True, stream = False, processes: int = None, useIndex = True, pathMap = None, mode: str = "literal"):
+    """Searches a flat file database. The database is streamed, so memory use does not grow with its size.
     :param db: The path to the flat file database generated by generateFlatFileDB
-    :param outFile: The path to save the subset database in, will output list otherwise
-    :param searchTerms: Strings that paths must include
-    :param includeTerms: Strings that paths must include at least one of 
-    :param excludeTerms: Strings that paths must not include
+    :param outFile: The path to save the subset database in, will output list otherwise. Binary DBs are saved as binary
+    :param searchTerms: Strings (or patterns) that paths must include
+    :param includeTerms: Strings (or patterns) that paths must include at least one of 
+    :param excludeTerms: Strings (or patterns) that paths must not include
     :param caseSensitive: Is case important?, defaults to False
     :param verbose: Print progress messages?, defaults to True
+    :param stream: Return a generator of matches instead of a list?, defaults to False
+    :param processes: Number of processes to search newline-aligned shards of a text DB file with, defaults to 1
+    :param useIndex: Only check the candidate paths from an up-to-date trigram index ('<db>.tri') if there is one?, defaults to True
+    :param pathMap: Prefix mappings (see compilePathMap) to rewrite the matching paths with as they are returned. Terms match the stored paths
+    :param mode: How terms are matched: 'literal' substrings (anchored with ^ and $), 'regex' searches, or 'glob' patterns matching the 
+                 whole path. Patterns are only run on the paths that contain their literal fragments, defaults to 'literal'
     """
     #TODO: Remove the error/exclamation marks from the progress bars
     searchTerms = [searchTerms] if isinstance(searchTerms, str) else searchTerms
     includeTerms = [includeTerms] if isinstance(includeTerms, str) else includeTerms
     excludeTerms = [excludeTerms] if isinstance(excludeTerms, str) else excludeTerms
 
-    if isinstance(db, str): db = set(open(db))
-
-    db = {str(file).strip() for file in db}
-
-    # Keep by searchTerms
-    if (len(searchTerms)):
-        automatons = [generateSearchAutomaton(term, caseSensitive = caseSensitive) for term in searchTerms]
-        out = set()
-        with alive_bar(total = len(db), title="Checking for search terms....", unknown="dots_waves", disable = not verbose) as bar:
-            for file in set(db):
-                f = f"^{file}$"
-                add = [next(automaton.iter(f if caseSensitive else f.lower()),False) for automaton in automatons]         
-                if all(add): 
-                    out.add(file)
-                    bar()
-        db = copy.deepcopy(out)
-
-    # Keep by includeAutomaton
-    if (len(includeTerms)):
-        includeAutomaton = generateSearchAutomaton(includeTerms, caseSensitive = caseSensitive)
-        out = set()
-        with alive_bar(total = len(db), title="Checking for include terms...", unknown="dots_waves", disable = not verbose) as bar:
-            for file in set(db):
-                f = f"^{file}$"
-                if (next(includeAutomaton.iter(f if caseSensitive else f.lower()),False)): 
-                    out.add(file)
-                    bar()
-        db = copy.deepcopy(out)
-
-    # Remove by excludeTerms
-    if (len(excludeTerms)):
-        excludeAutomaton = generateSearchAutomaton(excludeTerms, caseSensitive = caseSensitive)
-        out = copy.deepcopy(db)
-        with alive_bar(total = len(db), title="Checking for exclude terms...", unknown="dots_waves", disable = not verbose) as bar:
-            for file in set(out):             
-                if (next(excludeAutomaton.iter(file if caseSensitive else file.lower()),False)): 
-                    db.discard(file)
-                else:
-                    bar()
-
-    db = list(db)
-
-    if (outFile is not None):
-        with open(outFile, 'w') as f:
-            for line in db:
-                f.write(f"{line.strip()}\n")
-
-    return (db if outFile is None else outFile)
-
-def filterFileClass(db: list, classToFilter: str, inclusive:bool = False):
-    """Remove either files/folders from list output from generateFlatFileDB.
-    :param db: list output from generateFlatFileDB
-    :param classToFilter: the type of file to remove (either 'file', 'folder', or 'symlink')
+    if mode not in ["literal", "regex", "glob"]:
+        raise ValueError("Invalid choice for 'mode'. Choose either 'literal', 'regex', or 'glob'.")
+    if (mode == "literal"):
+        matcher, query = _queryMatches, _compileQuery(searchTerms, includeTerms, excludeTerms, caseSensitive)
+        literals = (searchTerms, includeTerms)
+    else:
+        matcher, (query, literals) = _patternMatches, _compilePatternQuery(mode, searchTerms, includeTerms, excludeTerms, caseSensitive)
+
+    candidates = _trigramCandidates(db, *literals) if (useIndex and isinstance(db, str)) else None
+    if (candidates is not None):
+        matches = (record for record in _readCandidates(db, *candidates) if matcher(query, record.path))
+    elif (processes is not None and processes > 1 and isinstance(db, str) and not isBinaryDB(db)):
+        matches = (DBRecord(path, None, None, None, None) for shard in _shardedMap(db, _searchShard, (matcher, query), processes) for path in shard)
+    else:
+        matches = (record for record in readFlatFileDB(db, metadata = True) if matcher(query, record.path))
+    if (pathMap is not None):
+        mapPath = _pathMapper(pathMap)
+        matches = (record._replace(path = mapPath(record.path)) for record in matches)
+
+    if (outFile is None and stream):
+        return (record.path for record in matches)
+
+    with alive_bar(title="Searching...", unknown="dots_waves", disable = not verbose) as bar:
+        def counted(records):
+            for record in records:
+                bar()
+                yield record
+
+        if (outFile is None):
+            return list(dict.fromkeys(record.path for record in counted(matches)))
+        return writeFlatFileDB(counted(matches), outFile, isBinaryDB(db) if isinstance(db, str) else None)
+
+_INCLUDE, _EXCLUDE = -1, -2
+
+def generateQueryAutomaton(searchTerms: list[str] = [], includeTerms: list[str] = [], excludeTerms: list[str] = [], caseSensitive = False, cache = False):
+    """Generates a single search automaton for a query, with each term tagged by its role
+    :param searchTerms: Strings that paths must include, tagged by their index
+    :param includeTerms: Strings that paths must include at least one of, tagged -1
+    :param excludeTerms: Strings that paths must not include, tagged -2
+    :param caseSensitive: Is case important?, defaults to False
+    :param cache: Reuse a cached automaton for the same query (see _cachedAutomaton)? Cached automatons are shared, so do not modify them, defaults to False
+    :return: An automaton whose values are (term, tags), or None if there are no terms
+    """
+    if not (searchTerms or includeTerms or excludeTerms): return None
+
+    def build():
+        key = (lambda term: str(term)) if caseSensitive else (lambda term: str(term).lower())
+        tags = defaultdict(set)
+        for idx, term in enumerate(searchTerms): tags[key(term)].add(idx)
+        for term in includeTerms: tags[key(term)].add(_INCLUDE)
+        for term in excludeTerms: tags[key(term)].add(_EXCLUDE)
+        automaton = ahocorasick.Automaton()
+        for term, tag in tags.items():
+            automaton.add_word(term, (term, frozenset(tag)))
+        automaton.make_automaton()
+        return automaton
+
+    if not cache: return build()
+    return _cachedAutomaton(("query", caseSensitive, tuple(searchTerms), tuple(includeTerms), tuple(excludeTerms)), build)
+
+def _compileQuery(searchTerms: list[str] = [], includeTerms: list[str] = [], excludeTerms: list[str] = [], caseSensitive = False):
+    """Compiles a query into a picklable tuple of (automaton, number of search terms, has include terms, caseSensitive)."""
+    automaton = generateQueryAutomaton(searchTerms, includeTerms, excludeTerms, caseSensitive, cache = True)
+    return (automaton, len(searchTerms), len(includeTerms) > 0, caseSensitive)
+
+def _queryMatches(query: tuple, path: str):
+    """Checks a path against a compiled query in a single scan. Paths are wrapped in ^...$ so terms can be anchored.
+    :param query: The query from _compileQuery
+    :param path: The path to check
+    :return: True if the path has every search term, at least one include term and no exclude terms
+    """
+    automaton, nSearch, include, caseSensitive = query
+    if automaton is None: return True
+    path = f"^{path}$"
+    hit = set()
+    for _, (term, tags) in automaton.iter(path if caseSensitive else path.lower()):
+        if _EXCLUDE in tags: return False
+        hit |= tags
+    return (not include or _INCLUDE in hit) and sum(1 for tag in hit if tag >= 0) == nSearch
+
+def _regexLiterals(pattern: re.Pattern, caseSensitive = False):
+    """Finds literal fragments that every match of a regex must contain, to prefilter paths with the query automaton.
+    :param pattern: The compiled regex
+    :param caseSensitive: Will the fragments be matched case-sensitively? Case-insensitive parts of the regex are then skipped
+    :return: A list of fragments, starting with ^ or ending with $ where the regex is anchored. Empty if none were found
+    """
+    try:
+        from re import _parser as sre_parse, _constants as sre
+    except ImportError: # Python < 3.11
+        import sre_parse, sre_constants as sre
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return []
+    if caseSensitive and parsed.state.flags & re.IGNORECASE: return []
+
+    fragments, run = [], []
+    def flush():
+        if "".join(run).strip("^$"): fragments.append("".join(run))
+        run.clear()
+
+    def walk(items):
+        for op, av in items:
+            if op == sre.LITERAL and chr(av) not in "^$": 
+                run.append(chr(av))
+            elif op == sre.AT:
+                if av in (sre.AT_BEGINNING, sre.AT_BEGINNING_STRING): 
+                    flush()
+                    run.append("^")
+                elif av in (sre.AT_END, sre.AT_END_STRING):
+                    run.append("$")
+                    flush()
+                # Other assertions (e.g. \b) are zero-width, so the literals either side stay adjacent
+            elif op == sre.SUBPATTERN and not (caseSensitive and av[1] & re.IGNORECASE):
+                walk(av[-1])
+            elif op == getattr(sre, "ATOMIC_GROUP", None):
+                walk(av)
+            elif op in (sre.MAX_REPEAT, sre.MIN_REPEAT, getattr(sre, "POSSESSIVE_REPEAT", None)) and av[0] >= 1:
+                flush()
+                walk(av[2])
+                flush()
+            else:
+                flush()
+    walk(parsed)
+    flush()
+    return fragments
+
+def _compilePatternQuery(mode: str, searchTerms: list[str] = [], includeTerms: list[str] = [], excludeTerms: list[str] = [], caseSensitive = False):
+    """Compiles a regex or glob query into a picklable tuple of (literal prefilter query, search, include and exclude patterns).
+    The prefilter requires the literal fragments of every search pattern and one fragment of each include pattern.
+    :return: The query, and the (search, include) literal fragments, e.g. for the trigram index
+    """
+    flags = 0 if caseSensitive else re.IGNORECASE
+    compile = lambda term: re.compile("^" + fnmatch.translate(term) if mode == "glob" else term, flags) # Globs match whole paths
+    search, include, exclude = ([compile(term) for term in terms] for terms in (searchTerms, includeTerms, excludeTerms))
+    searchLiterals = list(chain.from_iterable(_regexLiterals(pattern, caseSensitive) for pattern in search))
+    includeLiterals = [max(_regexLiterals(pattern, caseSensitive) or [None], key = lambda fragment: len(fragment or "")) for pattern in include]
+    if None in includeLiterals: includeLiterals = [] # A pattern with no literals could match any path
+    return (_compileQuery(searchLiterals, includeLiterals, [], caseSensitive), search, include, exclude), (searchLiterals, includeLiterals)
+
+def _patternMatches(query: tuple, path: str):
+    """Checks a path against a query from _compilePatternQuery, only running the patterns if the literal prefilter passes."""
+    prefilter, search, include, exclude = query
+    return (_queryMatches(prefilter, path) and all(pattern.search(path) for pattern in search) 
+            and (not include or any(pattern.search(path) for pattern in include)) and not any(pattern.search(path) for pattern in exclude))
+
+def _shardFile(file: str, shardSize: int):
+    """Splits a text file into byte ranges aligned to newlines.
+    :param file: The path to the file
+    :param shardSize: The approximate size of each shard in bytes
+    :return: A list of (start, end) byte offsets
+    """
+    size = os.path.getsize(file)
+    bounds = [0]
+    with open(file, "rb") as f:
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + shardSize, size))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _readShard(file: str, start: int, end: int):
+    """Reads the lines of a shard from _shardFile."""
+    with open(file, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).decode().split("\n")
+    return lines[:-1] if lines and not lines[-1] else lines
+
+_shardState = None
+
+def _initShardWorker(state):
+    global _shardState
+    _shardState = state
+
+def _searchShard(shard: tuple):
+    """Searches one shard of a text DB with the (matcher, query) set by _initShardWorker."""
+    matcher, query = _shardState
+    return [path for path in _readShard(*shard) if matcher(query, path)]
+
+def _shardedMap(file: str, worker, state, processes: int):
+    """Runs a worker over newline-aligned shards of a text file in a process pool.
+    :param file: The path to the text file
+    :param worker: Module-level function taking (file, start, end) and returning a list
+    :param state: Picklable state (e.g. a compiled query) made available to the workers as _shardState
+    :param processes: Number of processes
+    :return: A generator of the worker results, in file order
+    """
+    shardSize = min(max(os.path.getsize(file) // (processes * 4), 1 << 20), 256 << 20)
+    shards = [(file, start, end) for start, end in _shardFile(file, shardSize)]
+    with ProcessPoolExecutor(max_workers = processes, initializer = _initShardWorker, initargs = (state,)) as executor:
+        yield from executor.map(worker, shards)
+
+def batchSearchFlatFileDB(db: str, terms: list[str], caseSensitive = False, asDataFrame = False, verbose = True, processes: int = None, pathMap = None):
+    """Finds the paths containing each of many terms (e.g. sample IDs) in a single pass over a flat file database.
+    :param db: The path to the flat file database generated by generateFlatFileDB, or a list of paths
+    :param terms: The terms to look up. Terms can be anchored with ^ and $ as in searchFlatFileDB
+    :param caseSensitive: Is case important?, defaults to False
+    :param asDataFrame: Return a DataFrame with 'term' and 'path' columns?, defaults to False
+    :param verbose: Print progress messages?, defaults to True
+    :param processes: Number of processes to search newline-aligned shards of a text DB file with, defaults to 1
+    :param pathMap: Prefix mappings (see compilePathMap) to rewrite the matching paths with. Terms match the stored paths
+    :return: A dictionary of term to list of matching paths (empty if not found), or a DataFrame of the hits
+    """
+    terms = [terms] if isinstance(terms, str) else list(dict.fromkeys(terms))
+    owners = defaultdict(list)
+    for term in terms: owners[str(term) if caseSensitive else str(term).lower()].append(term)
+    if not terms: return pd.DataFrame(columns = ["term", "path"]) if asDataFrame else {}
+    state = (generateSearchAutomaton(terms, caseSensitive = caseSensitive, cache = True), caseSensitive)
+
+    if (processes is not None and processes > 1 and isinstance(db, str) and not isBinaryDB(db)):
+        hits = (hit for shard in _shardedMap(db, _batchSearchShard, state, processes) for hit in shard)
+    else:
+        hits = ((path, found) for path in readFlatFileDB(db) for found in [_batchMatches(state, path)] if found)
+    if (pathMap is not None):
+        mapPath = _pathMapper(pathMap)
+        hits = ((mapPath(path), keys) for path, keys in hits)
+
+    found = {term: [] for term in terms}
+    with alive_bar(title="Searching...", unknown="dots_waves", disable = not verbose) as bar:
+        for path, keys in hits:
+            for key in keys:
+                for term in owners[key]: found[term].append(path)
+            bar()
+
+    if asDataFrame:
+        return pd.DataFrame([(term, path) for term, paths in found.items() for path in paths], columns = ["term", "path"])
+    return found
+
+def _batchMatches(state: tuple, path: str):
+    """Finds the (case-folded) terms of an automaton that occur in a path."""
+    automaton, caseSensitive = state
+    path = f"^{path}$"
+    return {term for _, term in automaton.iter(path if caseSensitive else path.lower())}
+
+def _batchSearchShard(shard: tuple):
+    """Finds the terms in each path of one shard of a text DB, using the state set by _initShardWorker."""
+    return [(path, found) for path in _readShard(*shard) for found in [_batchMatches(_shardState, path)] if found]
+
+# Trigram index: a header, a sorted table of (trigram, postings offset, count), the DB offset of each path, then the postings
+_TRI_MAGIC = b"STTI"
+_TRI_VERSION = 1
+_TRI_HEADER = struct.Struct("<4sHBQQQq")
+_TRI_ENTRY = struct.Struct("<12sQI")
+_TRI_OFFSET = struct.Struct("=Q")
+_TRI_RUN = struct.Struct("<12sI") # Sorted run of (trigram, count, ids) written while building an index
+_TRI_SKIP_RATIO = 8 # Posting lists this many times larger than the current candidates are not worth intersecting
+
+def _trigrams(text: str):
+    """Gets the set of case-folded trigrams of a string."""
+    text = text.lower()
+    return {text[idx:idx + 3] for idx in range(len(text) - 2)}
+
+def _trigramKey(trigram: str):
+    """Encodes a trigram as a fixed-width index table key."""
+    return trigram.encode(errors = "surrogatepass").ljust(12, b"\0")
+
+def _trigramRun(args: tuple):
+    """Builds the posting lists of one chunk of paths and writes them to a run file, sorted by trigram key."""
+    start, paths, file = args
+    postings = defaultdict(lambda: array("I"))
+    for idx, path in enumerate(paths, start):
+        for trigram in _trigrams(f"^{path}$"): postings[trigram].append(idx)
+    with open(file, "wb") as f:
+        for key, ids in sorted((_trigramKey(trigram), ids) for trigram, ids in postings.items()):
+            f.write(_TRI_RUN.pack(key, len(ids)))
+            f.write(ids.tobytes())
+    return file
+
+def _readTrigramRun(file: str, run: int):
+    """Reads a run file back as (trigram key, run number, posting list bytes), in key order."""
+    with open(file, "rb") as f:
+        while (head := f.read(_TRI_RUN.size)):
+            key, count = _TRI_RUN.unpack(head)
+            yield key, run, f.read(count * array("I").itemsize)
+
+def generateTrigramIndex(db: str, outFile: str = None, verbose = True, chunkSize: int = 100000, processes: int = None):
+    """Generates a trigram index of a flat file database, used by searchFlatFileDB to skip paths that cannot match.
+    Posting lists are built for chunkSize paths at a time and spilled to sorted run files next to outFile, which are then
+    merged, so memory is bounded by the chunk size (times the chunks in flight) and the number of distinct trigrams rather
+    than the size of the DB. The temporary runs take about as much disk space as the index.
+    :param db: The path to the flat file database generated by generateFlatFileDB
+    :param outFile: The output index path, defaults to '<db>.tri' where searchFlatFileDB looks for it
+    :param verbose: Show progress bar
+    :param chunkSize: Number of paths per run (a few hundred bytes of memory each), defaults to 100000
+    :param processes: Number of processes to build runs with, defaults to 1
+    :return: The path to the index
+    """
+    outFile = db + ".tri" if outFile is None else outFile
+    stat = os.stat(db)
+    with tempfile.TemporaryDirectory(dir = os.path.dirname(os.path.abspath(outFile))) as tmp:
+        nPaths = 0
+        offsetsFile = os.path.join(tmp, "offsets")
+        with alive_bar(title="Indexing paths...", unknown="dots_waves", disable = not verbose) as bar, open(offsetsFile, "wb") as offsets:
+            def chunks():
+                nonlocal nPaths
+                records = _iterDBOffsets(db)
+                while (chunk := list(islice(records, chunkSize))):
+                    for offset, _ in chunk: offsets.write(_TRI_OFFSET.pack(offset))
+                    yield nPaths, [path for _, path in chunk], os.path.join(tmp, f"run{nPaths}")
+                    nPaths += len(chunk)
+                    bar(len(chunk))
+
+            if processes is None or processes <= 1:
+                runs = [_trigramRun(chunk) for chunk in chunks()]
+            else:
+                with ProcessPoolExecutor(max_workers = processes) as executor:
+                    runs, pending = [], deque()
+                    for chunk in chunks(): # Keep at most processes + 1 chunks in memory
+                        pending.append(executor.submit(_trigramRun, chunk))
+                        if len(pending) > processes: runs.append(pending.popleft().result())
+                    runs += [future.result() for future in pending]
+
+        # Merge the runs: a trigram's ids are concatenated in run order, which keeps them sorted
+        table, position = [], 0
+        postingsFile = os.path.join(tmp, "postings")
+        with open(postingsFile, "wb") as postings:
+            merged = heapq.merge(*(_readTrigramRun(run, idx) for idx, run in enumerate(runs)))
+            for key, group in groupby(merged, key = lambda item: item[0]):
+                count = 0
+                for _, _, ids in group:
+                    postings.write(ids)
+                    count += len(ids) // array("I").itemsize
+                table.append((key, position, count))
+                position += count * array("I").itemsize
+
+        with open(outFile, "wb") as f:
+            f.write(_TRI_HEADER.pack(_TRI_MAGIC, _TRI_VERSION, isBinaryDB(db), nPaths, len(table), stat.st_size, stat.st_mtime_ns))
+            for entry in table: f.write(_TRI_ENTRY.pack(*entry))
+            for part in [offsetsFile, postingsFile]:
+                with open(part, "rb") as f_in: shutil.copyfileobj(f_in, f)
+    return outFile
+
+def _trigramCandidates(db: str, searchTerms: list[str], includeTerms: list[str]):
+    """Uses the trigram index of a database to find the paths that could match a query.
+    :param db: The path to the flat file database
+    :param searchTerms: Strings that paths must include
+    :param includeTerms: Strings that paths must include at least one of
+    :return: (sorted DB byte offsets of the candidates, is the DB binary), or None if there is no usable index or the
+             terms do not narrow the search enough to beat a sequential scan
+    """
+    index = db + ".tri"
+    if not os.path.exists(index): return None
+    stat = os.stat(db)
+    with open(index, "rb") as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+        magic, version, binary, nPaths, nTrigrams, dbSize, dbMtime = _TRI_HEADER.unpack_from(mm)
+        if magic != _TRI_MAGIC or version != _TRI_VERSION or (dbSize, dbMtime) != (stat.st_size, stat.st_mtime_ns): return None
+        tableStart = _TRI_HEADER.size
+        offsetsStart = tableStart + nTrigrams * _TRI_ENTRY.size
+        postingsStart = offsetsStart + nPaths * 8
+
+        def entry(trigram):
+            """Finds the (postings position, count) of a trigram."""
+            key = _trigramKey(trigram)
+            lo, hi = 0, nTrigrams
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if _TRI_ENTRY.unpack_from(mm, tableStart + mid * _TRI_ENTRY.size)[0] < key: lo = mid + 1
+                else: hi = mid
+            if lo == nTrigrams: return 0, 0
+            found, position, count = _TRI_ENTRY.unpack_from(mm, tableStart + lo * _TRI_ENTRY.size)
+            return (position, count) if found == key else (0, 0)
+
+        def posting(position, count):
+            ids = array("I")
+            ids.frombytes(mm[postingsStart + position:postingsStart + position + count * ids.itemsize])
+            return ids
+
+        def lookup(term):
+            """Gets a superset of the paths containing a term (the automaton does the final check), or None if it doesn't narrow the search."""
+            trigrams = _trigrams(str(term))
+            if not trigrams: return None
+            entries = sorted((entry(trigram) for trigram in trigrams), key = lambda entry: entry[1])
+            if entries[0][1] > nPaths // 4: return None
+            ids = set(posting(*entries[0]))
+            for position, count in entries[1:]:
+                if not ids or count > len(ids) * _TRI_SKIP_RATIO: break
+                ids.intersection_update(posting(position, count))
+            return ids
+
+        candidates = None
+        for term in searchTerms:
+            ids = lookup(term)
+            if ids is not None: candidates = ids if candidates is None else candidates & ids
+        if includeTerms:
+            included = [lookup(term) for term in includeTerms]
+            if all(ids is not None for ids in included):
+                included = set().union(*included)
+                candidates = included if candidates is None else candidates & included
+        if candidates is None or len(candidates) > nPaths // 4: return None
+
+        return [_TRI_OFFSET.unpack_from(mm, offsetsStart + idx * _TRI_OFFSET.size)[0] for idx in sorted(candidates)], bool(binary)
+
+def _readCandidates(db: str, offsets: list[int], binary: bool):
+    """Reads the DBRecords at the given byte offsets of a flat file database."""
+    with open(db, "rb") as f:
+        for offset in offsets: yield _readDBRecordAt(f, offset, binary)
+
+def _lstatRecord(path: str):
+    """Classifies a path as a DBRecord from a single lstat, only following symlinks to find the type of their target.
+    :param path: The path to stat
+    :return: A DBRecord (with the flags used by the binary DB), or None if the path does not exist
+    """
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return None
+    mode, flags = stat.st_mode, 0
+    if S_ISLNK(mode):
+        flags = DB_SYMLINK
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            mode = 0 # Broken link
+    if S_ISREG(mode): flags |= DB_FILE
+    elif S_ISDIR(mode): flags |= DB_DIR
+    return DBRecord(path, stat.st_size, stat.st_mtime, stat.st_ino, flags)
+
+def filterFileClass(db: list, classToFilter: str = None, inclusive:bool = False, minSize: int = None, maxSize: int = None, modifiedAfter = None, modifiedBefore = None, extensions: list[str] = None, threads: int = 8, cache: dict = None):
+    """Remove either files/folders from list output from generateFlatFileDB, optionally also matching on size, mtime and extension.
+    :param db: list output from generateFlatFileDB, or the path to the DB. Binary DBs are filtered without touching the filesystem
+    :param classToFilter: the type of file to remove (either 'file', 'folder', or 'symlink'), or None for any type
     :param inclusive: Should search be inclusive or exclusive?
+    :param minSize: Only match paths of at least this many bytes (lstat size)
+    :param maxSize: Only match paths of at most this many bytes (lstat size)
+    :param modifiedAfter: Only match paths modified at or after this time (epoch seconds or datetime)
+    :param modifiedBefore: Only match paths modified before this time (epoch seconds or datetime)
+    :param extensions: Only match paths ending in one of these extensions (e.g. ['.fastq.gz', '.bam'])
+    :param threads: Number of paths to lstat concurrently, for paths without metadata
+    :param cache: A dict of path to stat results, filled and reused across calls so chained filters only stat each path once
+    :return: The paths, in DB order
     """
-    if classToFilter not in ['file', 'folder', 'symlink']:
+    if classToFilter not in ['file', 'folder', 'symlink', None]:
         raise ValueError("Invalid choice for 'fileType'. Choose either 'file', 'folder', or 'symlink'.")
 
-    if isinstance(db, str): db = set(open(db))
-    db = {str(file).strip() for file in db}
-    files = set()
+    flag = {'file': DB_FILE, 'folder': DB_DIR, 'symlink': DB_SYMLINK, None: None}[classToFilter]
+    extensions = tuple([extensions] if isinstance(extensions, str) else extensions or [])
+    after, before = [None if t is None else t.timestamp() if hasattr(t, "timestamp") else float(t) for t in (modifiedAfter, modifiedBefore)]
+    needsStat = flag is not None or any(value is not None for value in (minSize, maxSize, after, before))
+    cache = {} if cache is None else cache
+
+    def matches(record: DBRecord):
+        if extensions and not record.path.endswith(extensions): return False
+        if not needsStat: return True
+        if record.flags is None:
+            if record.path not in cache: cache[record.path] = _lstatRecord(record.path)
+            record = cache[record.path]
+            if record is None: return False
+        return ((flag is None or record.flags & flag) and (minSize is None or record.size >= minSize) and (maxSize is None or record.size <= maxSize) 
+                and (after is None or record.mtime >= after) and (before is None or record.mtime < before))
+
+    def filterBatch(records: list):
+        return [record.path for record in records if bool(matches(record)) == inclusive]
+
+    records = readFlatFileDB(db, metadata = True)
+    batches = iter(lambda: list(islice(records, 64)), [])
+    return list(chain.from_iterable(_orderedMap(filterBatch, batches, threads)))
+
+def _splitPaths(paths: pd.Series):
+    """Splits '/'-separated paths into their parent directories and names (handling an empty Series).
+    :return: Series of (parents, names) aligned with the paths. Paths directly under '/' have the parent '/'
+    """
+    parts = paths.str.rpartition("/")
+    if parts.empty: return paths.copy(), paths.copy()
+    return parts[0].where((parts[0] != "") | (parts[1] == ""), "/"), parts[2]
+
+def _dbFrame(db):
+    """Reads a flat file database or generateDirTree DataFrame into a DataFrame of entries.
+    :param db: The path to the DB, a list of paths/DBRecords, or a DataFrame from generateDirTree
+    :return: A DataFrame of path, size, isDir and extension. Text DBs have no sizes. For text DBs (and frames without an
+             isDir column) directories are inferred as the parents of other paths, so empty directories count as files
+    """
+    if isinstance(db, pd.DataFrame):
+        frame = pd.DataFrame({"path": db["path"].astype(str), "size": db["size"] if "size" in db else float("nan")})
+        isDir = db["isDir"].astype(bool) if "isDir" in db else None # 'type' is 'Folder' for extensionless files too
+    else:
+        frame = pd.DataFrame.from_records(readFlatFileDB(db, metadata = True), columns = DBRecord._fields)
+        flags = frame.pop("flags")
+        isDir = None if flags.isna().any() else (flags.astype(int) & (DB_DIR | DB_SYMLINK)) == DB_DIR # Don't descend symlinks, like du
+        frame = frame[["path", "size"]]
+    frame["path"] = frame["path"].str.rstrip("/").where(frame["path"] != "/", "/")
+    frame["size"] = frame["size"].astype(float)
+    parents, names = _splitPaths(frame["path"])
+    if isDir is None: isDir = frame["path"].isin(parents.unique())
+    frame["isDir"] = isDir.to_numpy(dtype = bool)
+    frame["extension"] = [_fileExtension(name) for name in names]
+    return frame
+
+def rollupFlatFileDB(db, maxDepth: int = None, byExtension = False):
+    """Totals file counts and sizes for every directory in a flat file database (like du), without touching the filesystem.
+    :param db: The path to the DB, a list of paths/DBRecords, or a DataFrame from generateDirTree
+    :param maxDepth: Only report directories up to this many levels below the common root of the DB
+    :param byExtension: Break each directory's totals down by file extension?
+    :return: A DataFrame of dir, depth, (extension,) files and size, sorted by dir. Totals are recursive; sizes are apparent sizes in bytes (MiB for generateDirTree frames) and NaN for text DBs
+    """
+    entries = _dbFrame(db)
+    keys = ["dir", "extension"] if byExtension else ["dir"]
+    files = entries[~entries["isDir"]]
+    level = files.assign(dir = _splitPaths(files["path"])[0], files = 1)
+    if not byExtension: # Empty directories still get a (zero) total
+        dirs = entries[entries["isDir"]]
+        level = pd.concat([level, dirs.assign(dir = dirs["path"], files = 0, size = dirs["size"] * 0)])
+    level = level.groupby(keys, sort = False)[["files", "size"]].sum(min_count = 1).reset_index()
+    if level.empty: return pd.DataFrame(columns = ["dir", "depth"] + keys[1:] + ["files", "size"])
 
-    if classToFilter == 'file': 
-        files = {path for path in db if os.path.isfile(path)}
-    elif classToFilter == 'folder': 
-        files = {path for path in db if os.path.isdir(path)}
-    elif classToFilter == 'symlink': 
-        files = {path for path in db if os.path.islink(path)}
+    try:
+        root = os.path.commonpath(level["dir"].unique().tolist())
+    except ValueError: # Mixed absolute and relative paths
+        root = ""
+
+    # Push each directory's totals up one level at a time, so every file is added to each of its ancestors once
+    levels = [level]
+    while not (level := level[level["dir"].str.len() > len(root)]).empty:
+        parents = _splitPaths(level["dir"])[0]
+        level = level.assign(dir = parents)
+        level = level.groupby(keys, sort = False)[["files", "size"]].sum(min_count = 1).reset_index()
+        levels.append(level)
+    rollup = pd.concat(levels).groupby(keys)[["files", "size"]].sum(min_count = 1).reset_index()
+
+    relative = rollup["dir"].str.slice(len(root.rstrip("/")))
+    rollup.insert(1, "depth", relative.str.count("/").where(rollup["dir"] != root, 0))
+    rollup["files"] = rollup["files"].astype(int)
+    if maxDepth is not None: rollup = rollup[rollup["depth"] <= maxDepth]
+    return rollup.reset_index(drop = True)
+
+def extensionInventory(db):
+    """Counts the files and total size of each file extension in a flat file database, without touching the filesystem.
+    :param db: The path to the DB, a list of paths/DBRecords, or a DataFrame from generateDirTree
+    :return: A DataFrame of extension, files and size, largest first. Sizes are NaN for text DBs
+    """
+    files = _dbFrame(db)
+    files = files[~files["isDir"]].assign(files = 1)
+    inventory = files.groupby("extension")[["files", "size"]].sum(min_count = 1).reset_index()
+    return inventory.sort_values(["size", "files"], ascending = False, na_position = "last").reset_index(drop = True)
 
-    return list(files) if inclusive else list(db.difference(files))
 
 def findOrRemoveEmptyDirs(baseFolder: str, remove=False):
     """Finds a list of empty directories, removes them if desired.
@@ -292,14 +1038,88 @@ def flattenDirectory(directory: str, excludeDirs: list[str] = []):
         shutil.move(src_path, dest_path)
     os.rmdir(directory)
 
-def flattenAndPruneDirectory(directory: str):
-    """Utility function to iteratively flatten nesting + remove empty dirs.
+def _scanTreeNodes(directory: str, threads: int = 1):
+    """Lists a directory tree into memory in one scandir pass. Symlinks are not descended.
+    :param directory: The root directory
+    :param threads: The number of directories to list concurrently
+    :return: Nested dicts of name to child: a dict for directories, 'link' for symlinks to directories and 'file' otherwise
+    """
+    nodes = {directory: {}}
+    def scan(path, depth):
+        entries = _scanDir(path)
+        return [(path, entries)], [entry.path for entry in entries if not entry.is_symlink() and _isDir(entry)]
+    for (path, entries), in _walkTree([directory], scan, threads):
+        node = nodes[path]
+        for entry in entries:
+            if not entry.is_symlink() and _isDir(entry): node[entry.name] = nodes[entry.path] = {}
+            else: node[entry.name] = "link" if _isDir(entry) else "file"
+    return nodes[directory]
+
+def planFlattenAndPrune(directory: str, threads: int = 1):
+    """Plans flattenAndPruneDirectory from a single listing of the tree, without touching the filesystem again. Every
+    directory that is the only item in its parent is flattened into the parent (deepest first, renaming items that
+    clash to 'name_1.ext', ...), then directories left without files are removed. Lone symlinks to directories are unlinked.
+    :param directory: The directory to clean. It is never removed itself
+    :param threads: The number of directories to list concurrently
+    :return: A list of (operation, source, destination) steps for executeMovePlan
+    """
+    root = _scanTreeNodes(directory, threads)
+
+    # Nesting is decided from the tree as listed, like findNestedDirs, in depth-first order
+    nested, stack = [], [(directory, root)]
+    while stack:
+        path, node = stack.pop()
+        children = list(node.items())
+        if len(children) == 1 and children[0][1] != "file": nested.append((path, node, children[0][0]))
+        stack.extend((os.path.join(path, name), child) for name, child in reversed(children) if isinstance(child, dict))
+
+    plan = []
+    for parentPath, parent, name in reversed(nested):
+        path, node = os.path.join(parentPath, name), parent[name]
+        if node == "link":
+            plan += [("unlink", path, None), ("barrier", None, None)] # Before an ancestor is flattened, moving the link's directory
+            del parent[name]
+            continue
+        for item, child in node.items():
+            newItem, (base, ext), counter = item, os.path.splitext(item), 1
+            while newItem in parent:
+                newItem = f"{base}_{counter}{ext}"
+                counter += 1
+            plan.append(("move", os.path.join(path, item), os.path.join(parentPath, newItem)))
+            parent[newItem] = child
+        del parent[name]
+        plan.append(("rmdir", path, None))
+
+    # Remove directories with no files left under them, deepest first
+    def prune(path, node):
+        empty = True
+        for name, child in list(node.items()):
+            if isinstance(child, dict) and prune(os.path.join(path, name), child):
+                plan.append(("rmdir", os.path.join(path, name), None))
+                del node[name]
+            else:
+                empty = False
+        return empty
+    prune(directory, root)
+    return plan
+
+def flattenAndPruneDirectory(directory: str, dry_run = False, threads: int = 8, journal: str = None):
+    """Utility function to flatten nesting + remove empty dirs, planned from a single walk of the tree (see planFlattenAndPrune).
     :param directory: directory to clean.
+    :param dry_run: Only log the steps?, defaults to False
+    :param threads: Number of directories to list and steps to run concurrently, defaults to 8
+    :param journal: An optional journal file, to resume an interrupted clean-up (see executeMovePlan)
+    :return: The plan of (operation, source, destination) steps
+    :raises ValueError: The journal was written for a clean-up of another directory
     """
-    nested_dirs = findNestedDirs(directory)[::-1] # Get in reverse order to process bottom-up
-    for dir in nested_dirs: flattenDirectory(dir)
-    while findOrRemoveEmptyDirs(directory):
-        findOrRemoveEmptyDirs(directory, remove=True)
+    if journal is not None and os.path.exists(journal):
+        with open(journal + ".plan", "rb") as f: plan = pickle.load(f)
+        if any(path is not None and _relocate(path, directory, directory) is None for _, src, dst in plan for path in (src, dst)):
+            raise ValueError(f"Journal '{journal}' was written for a clean-up of another directory.")
+    else:
+        plan = planFlattenAndPrune(directory, threads)
+    executeMovePlan(plan, journal, threads, dry_run)
+    return plan
 
 def findDuplicateFileNames(paths: list[str] = []):
     """Find files with identical filenames under different directories.
@@ -315,24 +1135,181 @@ def findDuplicateFileNames(paths: list[str] = []):
     return duplicates
 
 
-def generateSearchAutomaton(searchTerms:list[str], file:str = None, caseSensitive = False):
+def findDuplicateFiles(db, minSize: int = 1, algorithm: str = "md5", sampleSize: int = 64 << 10, threads: int = 8, cache: str = None, verbose = True):
+    """Find files with identical content, hashing as little as possible. Files are grouped by size, then by a hash of
+    their first and last sampleSize bytes, and only then by a full checksum. Hard links to the same file are hashed once,
+    and groups made up only of hard links to one file are not reported.
+    :param db: A list of paths, or a flat file database. Binary databases provide the sizes without re-statting
+    :param minSize: Ignore files smaller than this many bytes, defaults to 1 (skip empty files)
+    :param algorithm: The hashlib or xxhash algorithm for the full checksum, defaults to md5
+    :param sampleSize: Bytes read from each end of a file for the partial hash, defaults to 64 KiB
+    :param threads: Number of files to stat/hash concurrently, defaults to 8
+    :param cache: An optional pickle file of previous checksums (see generateChecksumManifest)
+    :param verbose: Show progress bar
+    :return: A DataFrame with columns group, size, checksum and path, largest files first
+    """
+    def fileSize(record):
+        if record.flags is not None: 
+            return record.path, (record.size if record.flags & DB_FILE and not record.flags & DB_SYMLINK else None)
+        with suppress(OSError):
+            stat = os.lstat(record.path)
+            if S_ISREG(stat.st_mode): return record.path, stat.st_size
+        return record.path, None
+
+    def fileId(path):
+        with suppress(OSError):
+            stat = os.stat(path)
+            return path, (stat.st_dev, stat.st_ino)
+        return path, None
+
+    def partialHash(path):
+        with suppress(OSError):
+            digest = hashlib.md5()
+            with open(path, "rb") as f:
+                digest.update(f.read(sampleSize))
+                if f.seek(0, os.SEEK_END) > 2 * sampleSize: f.seek(-sampleSize, os.SEEK_END)
+                else: f.seek(sampleSize)
+                digest.update(f.read(sampleSize))
+            return path, digest.hexdigest()
+        return path, None
+
+    def regroup(groups, key):
+        """Splits each group of paths by a key computed in parallel, keeping groups of 2+ distinct files."""
+        keys = dict(_orderedMap(key, (path for paths in groups for path in paths), threads))
+        split = defaultdict(list)
+        for idx, paths in enumerate(groups):
+            for path in paths:
+                if keys[path] is not None: split[(idx, keys[path])].append(path)
+        return [paths for paths in split.values() if len({fileIds[path] for path in paths}) > 1]
+
+    with alive_bar(title="Grouping by size...", unknown="dots_waves", disable = not verbose) as bar:
+        sizes = defaultdict(list)
+        for path, size in _orderedMap(fileSize, readFlatFileDB(db, metadata = True), threads):
+            if size is not None and size >= minSize: sizes[size].append(path)
+            bar()
+    groups = [paths for paths in sizes.values() if len(paths) > 1]
+    sizeOf = {path: size for size, paths in sizes.items() if len(paths) > 1 for path in paths}
+
+    fileIds = dict(_orderedMap(fileId, (path for paths in groups for path in paths), threads))
+    groups = [[path for path in paths if fileIds[path] is not None] for paths in groups]
+    groups = [paths for paths in groups if len({fileIds[path] for path in paths}) > 1]
+
+    if verbose: print(f"Comparing partial hashes of {sum(len(paths) for paths in groups)} files...")
+    groups = regroup(groups, partialHash)
+
+    if verbose: print(f"Comparing full checksums of {sum(len(paths) for paths in groups)} files...")
+    checksums = _loadCache(cache)
+    hashed = {}
+    def fullHash(path):
+        if fileIds[path] not in hashed: hashed[fileIds[path]] = _cachedChecksum(path, algorithm, checksums)
+        return path, hashed[fileIds[path]]
+    groups = regroup(groups, fullHash)
+    _saveCache(cache, checksums)
+
+    rows = []
+    for idx, paths in enumerate(sorted(groups, key = lambda paths: (-sizeOf[paths[0]], sorted(paths)))):
+        rows += [(idx + 1, sizeOf[path], hashed[fileIds[path]], path) for path in sorted(paths)]
+    return pd.DataFrame(rows, columns = ["group", "size", "checksum", "path"])
+
+# Automatons are cached in memory (LRU) and, for larger term lists, pickled on disk keyed by a hash of the terms
+AUTOMATON_CACHE_DIR = os.environ.get("SEARCH_TOOLS_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "search_tools"))
+AUTOMATON_CACHE_ENTRIES = 32
+AUTOMATON_CACHE_BYTES = 1 << 30
+AUTOMATON_CACHE_MIN_SECONDS = 0.25
+_automatonCache = OrderedDict()
+_automatonCacheLock = threading.Lock()
+
+def _cachedAutomaton(key: tuple, build):
+    """Retrieves an automaton from the in-memory or on-disk cache, building and caching it if missing. The in-memory cache
+    is keyed on the terms as given, so a hit costs one tuple hash. Automatons are only cached on disk if building them took
+    at least AUTOMATON_CACHE_MIN_SECONDS, and a pickle is dropped if loading it turns out slower than building.
+    :param key: A hashable description of the automaton (its kind, case sensitivity and terms)
+    :param build: Function returning the automaton if it is not cached
+    :return: The automaton
+    """
+    with _automatonCacheLock:
+        if key in _automatonCache:
+            _automatonCache.move_to_end(key)
+            return _automatonCache[key]
+
+    file = None
+    if AUTOMATON_CACHE_DIR is not None:
+        file = os.path.join(AUTOMATON_CACHE_DIR, "automata", hashlib.sha256(pickle.dumps(key)).hexdigest() + ".pkl")
+    automaton = _loadCachedAutomaton(file) if (file is not None and os.path.exists(file)) else None
+    if automaton is None:
+        start = time.perf_counter()
+        automaton = build()
+        seconds = time.perf_counter() - start
+        if file is not None and seconds >= AUTOMATON_CACHE_MIN_SECONDS:
+            with suppress(OSError): _saveCachedAutomaton(file, automaton, seconds)
+
+    with _automatonCacheLock:
+        _automatonCache[key] = automaton
+        while len(_automatonCache) > AUTOMATON_CACHE_ENTRIES: _automatonCache.popitem(last = False)
+    return automaton
+
+def _loadCachedAutomaton(file: str):
+    """Loads a pickled automaton from the disk cache, removing the pickle if loading was no faster than building.
+    :return: The automaton, or None if it could not be loaded
+    """
+    start = time.perf_counter()
+    try:
+        with open(file, "rb") as f: buildSeconds, automaton = pickle.load(f)
+    except Exception:
+        return None
+    with suppress(OSError):
+        if time.perf_counter() - start >= buildSeconds: os.remove(file)
+        else: os.utime(file)
+    return automaton
+
+def _saveCachedAutomaton(file: str, automaton, buildSeconds: float):
+    """Pickles an automaton and its build time into the disk cache, then evicts the least recently used pickles over AUTOMATON_CACHE_BYTES."""
+    cacheDir = os.path.dirname(file)
+    os.makedirs(cacheDir, exist_ok = True)
+    tmp = f"{file}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f: pickle.dump((buildSeconds, automaton), f)
+    os.replace(tmp, file)
+
+    cached = [(stat.st_mtime, stat.st_size, entry.path) for entry in _scanDir(cacheDir) if entry.name.endswith(".pkl") for stat in [entry.stat()]]
+    total = sum(size for _, size, _ in cached)
+    for _, size, path in sorted(cached):
+        if total <= AUTOMATON_CACHE_BYTES: break
+        with suppress(OSError): os.remove(path)
+        total -= size
+
+def clearAutomatonCache(disk: bool = False):
+    """Clears the automaton cache used by generateSearchAutomaton and generateQueryAutomaton
+    :param disk: Also delete the pickled automatons in AUTOMATON_CACHE_DIR?, defaults to False
+    """
+    with _automatonCacheLock: _automatonCache.clear()
+    if disk and AUTOMATON_CACHE_DIR is not None:
+        shutil.rmtree(os.path.join(AUTOMATON_CACHE_DIR, "automata"), ignore_errors = True)
+
+def generateSearchAutomaton(searchTerms:list[str], file:str = None, caseSensitive = False, cache = False):
     """Generates a search automaton for Aho-Corasick search
     :param searchTerms: A list of search terms
     :param file: An optional output file to pickle into
+    :param caseSensitive: Is case important?, defaults to False
+    :param cache: Reuse a cached automaton for the same terms (see _cachedAutomaton)? Cached automatons are shared, so do not modify them, defaults to False
     :return: An automaton or the path to the pickle
     """
     if not isinstance(searchTerms, list): searchTerms = [searchTerms]
     searchTerms = [str(term) for term in searchTerms]
-    if (not caseSensitive): searchTerms = [term.lower() for term in searchTerms]
-    automaton = ahocorasick.Automaton()
-    for term in searchTerms:
-        automaton.add_word(term, term)
-    automaton.make_automaton()
+
+    def build():
+        automaton = ahocorasick.Automaton()
+        for term in searchTerms:
+            term = term if caseSensitive else term.lower()
+            automaton.add_word(term, term)
+        automaton.make_automaton()
+        return automaton
+
+    automaton = _cachedAutomaton(("search", caseSensitive, tuple(searchTerms)), build) if cache else build()
 
     if (file is not None):
         with open(file, "wb") as f:
             pickle.dump(automaton, f)
-        return f
+        return file
     else:
         return automaton
 
@@ -343,245 +1320,640 @@ def moveFileInTree(file:str, sourceDir:str, destDir:str):
     :param destDir: The destination directory
     :raises FileNotFoundError: Target file does not exist
     :raises FileNotFoundError: Target file does not exist in the source directory
+    :raises OSError: The file could not be moved (e.g. the destination is blocked)
     """
-    if not os.path.exists(file): raise FileNotFoundError(f"Cannot move file. '{file}' does not exist.")       
-    if (sourceDir not in file): raise FileNotFoundError(f"Cannot move file. '{file}' is not in {sourceDir}.")
-    if os.path.islink(file): os.unlink(file)
-    parentDir = str(Path(file).parent)
-    newFile = file.replace(sourceDir.strip("//"), destDir.strip("//"))
-    if (os.path.isfile(file)):
-        Path(newFile).parent.mkdir(parents = True, exist_ok = True)
-        shutil.move(file, newFile)
-    elif (os.path.isdir(file)):
-        parentDir = file
-        Path(newFile).mkdir(parents = True, exist_ok = True)
-    with (suppress(OSError)): os.rmdir(parentDir)
+    if not os.path.lexists(file): raise FileNotFoundError(f"Cannot move file. '{file}' does not exist.")       
+    if (_relocate(file, sourceDir, destDir) is None): raise FileNotFoundError(f"Cannot move file. '{file}' is not in {sourceDir}.")
+    failed = executeMovePlan(planMoves([file], sourceDir, destDir), threads = 1)
+    if failed: raise failed[0][2]
             
 def computeMD5(filename):
     """Compute the md5sum of a file."""
-    md5 = hashlib.md5()
-    with open(filename, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            md5.update(chunk)
-    return md5.hexdigest()
+    return computeChecksum(filename, "md5")
+
+_XXHASH_ALGORITHMS = ["xxh32", "xxh64", "xxh3_64", "xxh128", "xxh3_128"]
+
+def _newHash(algorithm: str):
+    """Creates a hash object for a hashlib algorithm (md5, sha1, sha256, ...) or an xxhash algorithm (xxh64, xxh3_64, xxh128, ...)."""
+    if algorithm in _XXHASH_ALGORITHMS:
+        import xxhash
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+def computeChecksum(filename: str, algorithm: str = "md5", blockSize: int = 8 << 20):
+    """Compute the checksum of a file using large reads.
+    :param filename: The path to the file
+    :param algorithm: The hashlib or xxhash algorithm, defaults to md5
+    :param blockSize: The number of bytes to read at a time, defaults to 8 MiB
+    :return: The hex digest
+    """
+    digest = _newHash(algorithm)
+    buffer = bytearray(blockSize)
+    view = memoryview(buffer)
+    with open(filename, 'rb', buffering = 0) as f:
+        while (n := f.readinto(buffer)):
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+def _loadCache(cache: str):
+    """Loads a pickled cache (e.g. checksums keyed on (device, inode, size, mtime, algorithm)), or an empty one."""
+    if cache is None or not os.path.exists(cache): return {}
+    with open(cache, "rb") as f: return pickle.load(f)
+
+def _saveCache(cache: str, data: dict):
+    if cache is None: return
+    with open(cache + ".tmp", "wb") as f: pickle.dump(data, f)
+    os.replace(cache + ".tmp", cache)
+
+def _cachedChecksum(path: str, algorithm: str, checksums: dict):
+    """Computes the checksum of a regular file, reusing the cached digest if its (device, inode, size, mtime) are unchanged.
+    :return: The hex digest, or None if the path is not a regular file
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode): return None
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, algorithm)
+    if key not in checksums: checksums[key] = computeChecksum(path, algorithm)
+    return checksums[key]
+
+def _manifestLine(digest: str, path: str):
+    """Formats an md5sum-style manifest line, escaping backslashes and newlines in the path as md5sum does."""
+    if "\\" in path or "\n" in path: return "\\" + digest + "  " + path.replace("\\", "\\\\").replace("\n", "\\n") + "\n"
+    return f"{digest}  {path}\n"
+
+def generateChecksumManifest(files, outFile: str = None, algorithm: str = "md5", threads: int = 8, cache: str = None, verbose = True):
+    """Computes the checksums of many files in parallel, optionally writing an md5sum-compatible manifest.
+    :param files: A list of paths, or a flat file database. Directories and other non-regular files are skipped
+    :param outFile: The manifest to write ('<digest>  <path>' lines), will output a dictionary otherwise
+    :param algorithm: The hashlib or xxhash algorithm, defaults to md5
+    :param threads: Number of files to hash concurrently, defaults to 8
+    :param cache: An optional pickle file of previous checksums, so unchanged files are not hashed again
+    :param verbose: Show progress bar
+    :return: A dictionary of path to digest, or the path to the manifest
+    """
+    checksums = _loadCache(cache)
+    records = readFlatFileDB(files, metadata = True)
+    paths = (record.path for record in records if record.flags is None or (record.flags & DB_FILE))
+    out = {} if outFile is None else open(outFile, "w")
+
+    with alive_bar(title="Computing checksums...", unknown="dots_waves", disable = not verbose) as bar:
+        for path, digest in _orderedMap(lambda path: (path, _cachedChecksum(path, algorithm, checksums)), paths, threads):
+            if digest is None: continue
+            if outFile is None: out[path] = digest
+            else: out.write(_manifestLine(digest, path))
+            bar()
+
+    _saveCache(cache, checksums)
+    if outFile is not None: out.close()
+    return (out if outFile is None else outFile)
 
-def compressFile(filename):
+def readChecksumManifest(manifest: str):
+    """Reads an md5sum-style manifest.
+    :param manifest: The path to the manifest
+    :return: A dictionary of path to digest
+    """
+    checksums = {}
+    with open(manifest) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line: continue
+            escaped = line.startswith("\\")
+            digest, path = line[escaped:].split(" ", 1)
+            path = path[1:] if path[:1] in (" ", "*") else path
+            if escaped: path = re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), path)
+            checksums[path] = digest
+    return checksums
+
+def verifyChecksumManifest(manifest: str, algorithm: str = None, threads: int = 8, cache: str = None, verbose = True):
+    """Verifies the files of an md5sum-style manifest in parallel.
+    :param manifest: The path to the manifest
+    :param algorithm: The hashlib or xxhash algorithm, guessed from the digest length if not given (md5, sha1, sha256, sha512)
+    :param threads: Number of files to hash concurrently, defaults to 8
+    :param cache: An optional pickle file of previous checksums, so unchanged files are not hashed again
+    :param verbose: Show progress bar
+    :return: A DataFrame with columns path, expected, actual and status ('OK', 'FAILED' or 'MISSING')
+    """
+    expected = readChecksumManifest(manifest)
+    if algorithm is None:
+        lengths = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
+        digestLength = len(next(iter(expected.values()), "0" * 32))
+        if digestLength not in lengths: raise ValueError(f"Cannot guess the checksum algorithm of '{manifest}'. Specify 'algorithm'.")
+        algorithm = lengths[digestLength]
+    checksums = _loadCache(cache)
+
+    rows = []
+    with alive_bar(len(expected), title="Verifying checksums...", disable = not verbose) as bar:
+        for path, actual in _orderedMap(lambda path: (path, _cachedChecksum(path, algorithm, checksums)), expected, threads):
+            status = "MISSING" if actual is None else "OK" if actual == expected[path].lower() else "FAILED"
+            rows.append((path, expected[path], actual, status))
+            bar()
+
+    _saveCache(cache, checksums)
+    return pd.DataFrame(rows, columns = ["path", "expected", "actual", "status"])
+
+def compressFile(filename, level: int = 9):
     """Compress a file using gzip and return the path to the compressed file."""
     compressed_filename = filename + ".gz"
-    with open(filename, 'rb') as f_in, gzip.open(compressed_filename, 'wb') as f_out:
+    with open(filename, 'rb') as f_in, gzip.open(compressed_filename, 'wb', compresslevel = level) as f_out:
         shutil.copyfileobj(f_in, f_out)
     os.remove(filename)
     return compressed_filename
 
-
-def sampleAndCopyFiles(rootSource: str, rootDest: str, numFiles=1000, dry_run=True):
+def _gzipBlocks(filename: str, outFile: str, level: int, blockSize: int, threads: int):
+    """Gzips a file as a multi-member gzip, compressing blocks in parallel (zlib releases the GIL).
+    At most threads + 1 blocks are held in memory at once.
+    :return: (crc32, length) of the uncompressed data
+    """
+    crc, length = 0, 0
+    mtime = int(os.stat(filename).st_mtime)
+    def blocks(f):
+        nonlocal crc, length
+        while (block := f.read(blockSize)):
+            crc, length = zlib.crc32(block, crc), length + len(block)
+            yield block
+    with open(filename, "rb") as f_in, open(outFile, "wb") as f_out:
+        for member in _orderedMap(lambda block: gzip.compress(block, compresslevel = level, mtime = mtime), blocks(f_in), threads, inFlight = threads + 1):
+            f_out.write(member)
+    return crc, length
+
+def _gunzipCRC(filename: str, blockSize: int = 8 << 20):
+    """Decompresses a (multi-member) gzip file, returning (crc32, length) of its content."""
+    crc, length = 0, 0
+    with gzip.open(filename, "rb") as f:
+        while (block := f.read(blockSize)):
+            crc, length = zlib.crc32(block, crc), length + len(block)
+    return crc, length
+
+def _compressWorker(args: tuple):
+    """Compresses one file for compressFiles, returning its report row. Errors are reported in the row rather than raised."""
+    filename, level, blockSize, threads, verify, remove = args
+    start = time.perf_counter()
+    outFile, inBytes, outBytes, verified, error = filename + ".gz", None, None, None, None
+    try:
+        crc, inBytes = _gzipBlocks(filename, outFile, level, blockSize, threads)
+        verified = (_gunzipCRC(outFile) == (crc, inBytes)) if verify else None
+        if verified is False:
+            logging.error(f"Compressed {outFile} does not match {filename}. Keeping the original...")
+            os.remove(outFile)
+            outFile = None
+        else:
+            outBytes = os.path.getsize(outFile)
+            if remove: os.remove(filename)
+    except (OSError, zlib.error, EOFError) as e:
+        logging.error(f"Failed to compress {filename}: {e}")
+        if outBytes is None: # Drop any partial output, keeping the original
+            if outFile is not None and os.path.exists(outFile): os.remove(outFile)
+            outFile = None
+        error = str(e)
+    seconds = time.perf_counter() - start
+    return (filename, outFile, inBytes, outBytes, seconds, inBytes / (1 << 20) / seconds if seconds and inBytes is not None else None, verified, error)
+
+def compressFiles(files: list[str], level: int = 6, processes: int = None, threads: int = None, blockSize: int = 64 << 20, verify = True, remove = True, verbose = True):
+    """Gzip many files in parallel. Files are spread across a process pool and large files are additionally split into
+    blocks compressed by a thread pool, giving standard multi-member gzip output.
+    :param files: The paths to the files to compress
+    :param level: The gzip compression level, defaults to 6
+    :param processes: Number of files to compress at once, defaults to the number of CPUs (or files)
+    :param threads: Number of blocks of each file to compress at once, defaults to spreading the remaining CPUs
+    :param blockSize: The size of the independently compressed blocks, defaults to 64 MiB
+    :param verify: Check the decompressed CRC and length against the source before removing it?, defaults to True.
+                   Files that fail are left uncompressed
+    :param remove: Remove the source files after compressing?, defaults to True
+    :param verbose: Show progress bar
+    :return: A DataFrame with columns file, output, inBytes, outBytes, seconds, MBps, verified and error.
+             Files that could not be compressed have no output and the error message
+    """
+    files = [files] if isinstance(files, str) else list(files)
+    cpus = os.cpu_count() or 1
+    processes = max(1, min(len(files), cpus)) if processes is None else processes
+    threads = max(1, cpus // processes) if threads is None else threads
+    jobs = [(file, level, blockSize, threads, verify, remove) for file in files]
+
+    rows = []
+    with alive_bar(len(jobs), title="Compressing files...", disable = not verbose) as bar, ProcessPoolExecutor(max_workers = processes) as executor:
+        for row in (executor.map(_compressWorker, jobs) if processes > 1 else map(_compressWorker, jobs)):
+            rows.append(row)
+            bar()
+
+    return pd.DataFrame(rows, columns = ["file", "output", "inBytes", "outBytes", "seconds", "MBps", "verified", "error"])
+
+def _copyFile(src: str, dst: str):
+    """Copies a file with its metadata, using in-kernel copy offload (copy_file_range, e.g. reflinks or server-side NFS
+    copies) where available and falling back to a regular copy."""
+    copied = False
+    if hasattr(os, "copy_file_range"):
+        with suppress(OSError), open(src, "rb") as f_in, open(dst, "wb") as f_out:
+            size = os.fstat(f_in.fileno()).st_size
+            while os.copy_file_range(f_in.fileno(), f_out.fileno(), 1 << 30): pass
+            copied = os.fstat(f_out.fileno()).st_size == size
+    if not copied: shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+def sampleAndCopyFiles(rootSource: str, rootDest: str, numFiles=1000, dry_run=True, stratify: str = None, threads: int = 8):
     """Sub-sample and copy files of a directory to a destination while keeping the directory structure.
+    Files are reservoir sampled while walking, so memory scales with numFiles rather than the size of the tree.
+    The tree is walked serially in a fixed order, so seeding `random` reproduces the selection.
 
     :param rootSource: directory to sub-sample and copy
     :param rootDest: destination where files will be copied to
-    :param numFiles: number of files to sub-sample
+    :param numFiles: number of files to sub-sample (per stratum if stratified)
+    :param dry_run: Only print what would be copied?, defaults to True
+    :param stratify: Sample numFiles from each top-level subdirectory ('dir') or each file extension ('ext')?, defaults to None
+    :param threads: Number of files to copy concurrently, defaults to 8
+    :return: The selected files
     """
-    all_files = generateFlatFileDB(rootSource)
-    
-    # Randomly select files
-    selected_files = random.sample(all_files, min(numFiles, len(all_files)))
+    if stratify not in [None, 'dir', 'ext']:
+        raise ValueError("Invalid choice for 'stratify'. Choose either 'dir', 'ext' or None.")
+
+    def stratum(path):
+        if stratify == 'dir': 
+            relative_path = os.path.relpath(path, rootSource)
+            return relative_path.split(os.sep)[0] if os.sep in relative_path else "."
+        if stratify == 'ext': return _fileExtension(os.path.basename(path))
+        return None
+
+    def scan(path, depth):
+        dirs, files = [], []
+        for entry in _scanDir(path): (dirs if _isDir(entry) else files).append(entry)
+        return [entry.path for entry in files if entry.is_file()], [entry.path for entry in dirs if not entry.is_symlink()]
+
+    # Randomly select files. A parallel walk would feed the reservoir in listing completion order
+    seen, reservoirs = defaultdict(int), defaultdict(list)
+    for files in _walkTree([rootSource], scan):
+        for file_path in files:
+            key = stratum(file_path)
+            seen[key] += 1
+            if len(reservoirs[key]) < numFiles: reservoirs[key].append(file_path)
+            elif (idx := random.randrange(seen[key])) < numFiles: reservoirs[key][idx] = file_path
+    selected_files = [file_path for files in reservoirs.values() for file_path in files]
     
     # Copy selected files to destination, maintaining directory structure
-    for file_path in selected_files:
-        # Compute destination path
-        relative_path = os.path.relpath(file_path, rootSource)
-        dest_path = os.path.join(rootDest, relative_path)
-
-        # Create destination directory if it doesn't exist
-        dest_dir = os.path.dirname(dest_path)
+    def copy(file_path):
+        dest_path = os.path.join(rootDest, os.path.relpath(file_path, rootSource))
         if dry_run:
-            print(f"Would create directory: {dest_dir}")
+            print(f"Would copy {file_path} to {dest_path}")
+            return
+        Path(dest_path).parent.mkdir(parents=True, exist_ok=True)
+        try:
+            _copyFile(file_path, dest_path)
+        except OSError as e:
+            logging.error(f"Could not copy {file_path}: {str(e)}. Skipping...")
+
+    list(_orderedMap(copy, selected_files, 1 if dry_run else threads))
+    return selected_files
+
+def _relocate(file: str, sourceDir: str, destDir: str):
+    """Maps a path under sourceDir to the same relative path under destDir.
+    :return: The new path, or None if the path is not under sourceDir
+    """
+    source, path = os.path.abspath(sourceDir), os.path.abspath(file)
+    if os.path.commonpath([source, path]) != source: return None
+    relative = os.path.relpath(path, source)
+    return destDir if relative == "." else os.path.join(destDir, relative)
+
+def planMoves(files: list[str], sourceDir: str, destDir: str):
+    """Plans moving files from a source tree into the same relative paths under a destination tree. Symlinks are moved
+    as-is, unless they point at (absolute) paths that are also being moved, in which case they are recreated pointing
+    at the new location. Emptied source directories are removed.
+    :param files: The files (or DBRecords, or a flat file database) to move. Directories are recreated, not moved
+    :param sourceDir: The source directory
+    :param destDir: The destination directory
+    :return: A list of (operation, source, destination) steps for executeMovePlan
+    """
+    records = {}
+    for record in readFlatFileDB(files, metadata = True):
+        if _relocate(record.path, sourceDir, destDir) is None: 
+            logging.error(f"File {record.path} is not in the source directory. Skipping...")
         else:
-            Path(dest_dir).mkdir(parents=True, exist_ok=True)
-        
-        if os.path.isfile(file_path):
-            # Copy the file
-            if dry_run:
-                print(f"Would copy {file_path} to {dest_path}")
-            else:
-                shutil.copy2(file_path, dest_path)
+            records[record.path] = record
+
+    def flags(record):
+        if record.flags is not None: return record.flags
+        with suppress(OSError):
+            if os.path.islink(record.path): return DB_SYMLINK
+            return DB_DIR if os.path.isdir(record.path) else DB_FILE
+        return 0
+
+    mkdirs, moves, rmdirs = set(), [], set()
+    for path, record in records.items():
+        newPath = _relocate(path, sourceDir, destDir)
+        flag = flags(record)
+        if flag & DB_DIR and not flag & DB_SYMLINK:
+            mkdirs.add(newPath)
+            rmdirs.add(path)
+            continue
+        mkdirs.add(os.path.dirname(newPath))
+        rmdirs.add(os.path.dirname(path))
+        linkto = os.readlink(path) if flag & DB_SYMLINK else None
+        if linkto is not None and linkto in records: 
+            moves += [("symlink", _relocate(linkto, sourceDir, destDir), newPath), ("unlink", path, None)]
         else:
-            print(f"Skipping {file_path} because it's not a file.")
+            moves.append(("move", path, newPath))
+
+    return ([("mkdir", None, dir) for dir in sorted(mkdirs)] + moves + 
+            [("rmdir", dir, None) for dir in sorted(rmdirs, key = len, reverse = True)])
+
+def _runMoveOp(op: str, src: str, dst: str):
+    """Runs one step of a move plan. Steps that were already completed (e.g. before a crash) are not repeated."""
+    match op:
+        case "mkdir":
+            Path(dst).mkdir(parents = True, exist_ok = True)
+        case "move":
+            if not os.path.lexists(src) and os.path.lexists(dst): return
+            try:
+                os.rename(src, dst)
+            except OSError as e:
+                if e.errno != errno.EXDEV: raise
+                shutil.move(src, dst) # Copies across filesystems
+        case "symlink":
+            if os.path.islink(dst) and os.readlink(dst) == src: return
+            os.symlink(src, dst)
+        case "unlink":
+            with suppress(FileNotFoundError): os.unlink(src)
+        case "rmdir":
+            try:
+                os.rmdir(src)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                if e.errno != errno.ENOTEMPTY: raise
+                logging.info(f"Leaving {src} as it is not empty.")
+        case _:
+            raise ValueError(f"Unknown move plan operation '{op}'.")
+
+def executeMovePlan(plan: list[tuple], journal: str = None, threads: int = 8, dry_run = False):
+    """Executes a plan from planMoves. Moves, symlinks and unlinks between directory creations/removals (or explicit
+    ('barrier', None, None) steps) run in a thread pool, using os.rename where possible and copying across filesystems otherwise.
+    :param plan: The list of (operation, source, destination) steps, or None to resume the plan saved with the journal
+    :param journal: An optional file recording completed steps. The plan is saved alongside it ('<journal>.plan'), and
+                    running it again with the same journal resumes it. Both are removed once every step has succeeded
+    :param threads: Number of steps to run concurrently, defaults to 8
+    :param dry_run: Only log the steps?, defaults to False
+    :return: A list of (step index, step, error) for the steps that failed
+    """
+    if plan is None:
+        with open(journal + ".plan", "rb") as f: plan = pickle.load(f)
+    if dry_run:
+        for op, src, dst in plan: 
+            if op != "barrier": logging.info(f"Would {op} {src or ''} {dst or ''}".rstrip())
+        return []
 
-def splitFolder(files:list[str], sourceDir: str, destDir:str, dry_run=True, log_file=None):
-    """Splits a folder into two directories based on search criteria
+    signature = hashlib.sha256(pickle.dumps(plan)).hexdigest()
+    done = set()
+    if journal is not None and os.path.exists(journal):
+        with open(journal) as f:
+            if f.readline().strip() != signature: raise ValueError(f"Journal '{journal}' was written for a different plan.")
+            done = {int(line) for line in f if line.strip()}
+    log = None
+    if journal is not None:
+        if not os.path.exists(journal):
+            with open(journal + ".plan", "wb") as f: pickle.dump(plan, f)
+        log = open(journal, "a")
+        if log.tell() == 0: log.write(signature + "\n")
+    lock = threading.Lock()
+    failed = []
+
+    def run(idx):
+        op, src, dst = plan[idx]
+        try:
+            _runMoveOp(op, src, dst)
+        except (OSError, shutil.Error) as e:
+            logging.error(f"Could not {op} {src or dst}: {str(e)}. Skipping...")
+            with lock: failed.append((idx, plan[idx], e))
+            return
+        if log is not None:
+            with lock: 
+                log.write(f"{idx}\n")
+                log.flush()
+
+    with ThreadPoolExecutor(max_workers = max(1, threads)) as executor:
+        batch = []
+        for idx, (op, src, dst) in enumerate(plan + [("barrier", None, None)]):
+            if idx in done: continue
+            if op in ("move", "symlink", "unlink"):
+                batch.append(idx)
+                continue
+            list(executor.map(run, batch))
+            batch = []
+            if op != "barrier": run(idx)
+
+    if log is not None: 
+        log.close()
+        if not failed:
+            os.remove(journal)
+            os.remove(journal + ".plan")
+    return sorted(failed, key = lambda fail: fail[0])
+
+def splitFolder(files:list[str], sourceDir: str, destDir:str, dry_run=True, log_file=None, journal: str = None, threads: int = 8):
+    """Splits a folder into two directories based on search criteria. All the moves are planned first (see planMoves),
+    then executed in parallel (see executeMovePlan)
 
     Potential cases to worry about:
         - symlinks: can either recreate the symlink or copy as is. shutil should handle the latter
         - permission errors
 
+    :param files: the files to move
     :param sourceDir: the source directory
-    :param targetDir: the output directory
-    :param verbose: Print progress messages?, defaults to True
-    :param inverse: If true, move all files that do not match search criteria (ie. opposite behaviour)
+    :param destDir: the output directory
+    :param dry_run: Only log what would be done?, defaults to True
+    :param log_file: File to log to
+    :param journal: File recording completed moves. If it exists, the interrupted split it recorded is resumed
+    :raises ValueError: The journal was written for a split of other files
+    :param threads: Number of moves to run concurrently, defaults to 8
+    :return: A list of the failed steps
     """
-    logging.basicConfig(filename=log_file if log_file else None, level=logging.INFO)
-
     if log_file: 
         logging.basicConfig(filename=log_file, level=logging.INFO)
     else: 
         logging.basicConfig(level=logging.INFO)
 
-    # Check if all the input files are in the sourceDir
-    origFiles = files
-    files = set()
-    for file in origFiles:
-        if (sourceDir not in file): 
-            logging.error(f"File {file} is not in the source directory. Skipping...")
-        else:
-            files.add(file)
-
-    # Create parent folders
-    parentDirs = set([str(Path(file).parent) for file in files])
-    for parentDir in parentDirs:
-        newDir = Path(str(parentDir).replace(sourceDir.strip("//"), destDir.strip("//")))
-        if logging: 
-            logging.info(f"Creating {newDir}")
-        if not dry_run:            
-            newDir.mkdir(parents = True, exist_ok = True)
-   
-    # Move files
-    files = {file for file in files if not os.path.isdir(file)}
-    for file in files:
-        try:
-            newFile = file.replace(sourceDir.strip("//"), destDir.strip("//"))
-            if os.path.islink(file): 
-                linkto = os.readlink(file)
-                if (linkto in files): # Updates symlink if the target file is being moved as well
-                    linkto = linkto.replace(sourceDir.strip("//"), destDir.strip("//"))
-                os.symlink(linkto, newFile)
-                os.remove(file)
-            else:                
-                if logging:
-                    logging.info(f"Moving {file} to {newFile}")
-                if not dry_run:
-                    shutil.move(file, newFile)
-        except PermissionError:
-            logging.error(f"Permission denied while trying to move {file}. Skipping...")
-        except shutil.Error as e:
-            logging.error(f"An error occured while trying to move {file}: {str(e)}. Skipping...")
-
-    # Clean-up old directories. Delete if empty, leave if not    
-    parentDirs = [str(dir) for dir in list(parentDirs)]
-    for dir in sorted(parentDirs, key=len)[::-1]: 
-        if (log_file): logging.info(f"Deleting {dir}")
-        if not dry_run: 
-            try:
-                os.rmdir(dir)
-            except FileNotFoundError: 
-                logging.error(f"Could not find directory {dir} for deletion. Skipping...")
-            except OSError: 
-                logging.error(f"Could not delete directory {dir} as it is not empty. Skipping...")
+    if journal is not None and os.path.exists(journal):
+        with open(journal + ".plan", "rb") as f: plan = pickle.load(f)
+        sources = {src for _, src, _ in plan}
+        if any(_relocate(file, sourceDir, destDir) is not None and file not in sources for file in readFlatFileDB(files)):
+            raise ValueError(f"Journal '{journal}' was written for a split of other files.")
+    else:
+        plan = planMoves(files, sourceDir, destDir)
+    return executeMovePlan(plan, journal, threads, dry_run)
 
-def expandZipFlatFileDB(file: str):
-    import zipfile, tempfile, shutil
+ARCHIVE_EXTENSIONS = {".zip": "zip", ".tar": "tar", ".tar.gz": "tar", ".tgz": "tar", ".tar.bz2": "tar", ".tbz2": "tar", ".tbz": "tar"}
 
-    with open(file,"r") as infile:
-        with tempfile.NamedTemporaryFile(mode="w", delete = False) as tempFile:
-            for line in infile.readlines():
-                zip = zipfile.ZipFile(str.strip(line))
-                names = zip.namelist()
-                tempFile.write(line)
-                [tempFile.write(str.strip(line) + "/" + name + "\n") for name in names]
+def _archiveType(path: str, sniff = False):
+    """Identifies a zip or tar archive from its extension, or optionally from its magic bytes.
+    :param path: The path to the file
+    :param sniff: Read the header of files without an archive extension?
+    :return: 'zip', 'tar' or None
+    """
+    lower = path.lower()
+    for ext, kind in ARCHIVE_EXTENSIONS.items():
+        if lower.endswith(ext): return kind
+    if not sniff: return None
+    try:
+        with open(path, "rb") as f: header = f.read(512)
+    except OSError:
+        return None
+    if header[:4] in (b"PK\x03\x04", b"PK\x05\x06"): return "zip"
+    with suppress(Exception):
+        if header[:2] == b"\x1f\x8b": header = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(header, 512)
+        elif header[:3] == b"BZh": 
+            import bz2
+            header = bz2.BZ2Decompressor().decompress(header)[:512]
+    return "tar" if header[257:262] == b"ustar" else None
+
+def _listArchive(path: str, kind: str):
+    """Lists the members of a zip or tar archive.
+    :return: A list of (name, size, mtime, isDir)
+    """
+    if kind == "zip":
+        import zipfile
+        with zipfile.ZipFile(path) as archive:
+            return [(info.filename.rstrip("/"), info.file_size, time.mktime(info.date_time + (0, 0, -1)), info.is_dir()) for info in archive.infolist()]
+    import tarfile
+    with tarfile.open(path, "r:*") as archive:
+        return [(info.name.rstrip("/"), info.size, float(info.mtime), info.isdir()) for info in archive]
+
+def expandArchivesFlatFileDB(db: str, outFile: str = None, threads: int = 8, cache: str = None, sniff = False, verbose = True):
+    """Adds the members of zip and tar archives (.zip, .tar, .tar.gz/.tgz, .tar.bz2/.tbz2) in a flat file database to the database, as '<archive>/<member>'.
+    Members from an earlier run are replaced, so re-running only picks up changed archives.
+    :param db: The path to the DB
+    :param outFile: The output DB file. Defaults to rewriting the DB. Binary DBs stay binary, with member sizes and mtimes from the archive
+    :param threads: The number of archives to list concurrently
+    :param cache: Path to a pickle of archive listings keyed on (path, size, mtime). Re-runs only open new or changed archives
+    :param sniff: Also detect archives without an archive extension from their magic bytes? Opens every file in the DB
+    :param verbose: Show the progress bar?
+    :return: The path to the output DB file
+    """
+    outFile = db if outFile is None else outFile
+    binary = isBinaryDB(db)
+    listings = _loadCache(cache)
+    errors = []
+
+    def expand(record: DBRecord):
+        if record.flags is not None and not record.flags & DB_FILE: return [record]
+        kind = _archiveType(record.path, sniff)
+        if kind is None: return [record]
+        try:
+            stat = os.stat(record.path)
+            key = (record.path, stat.st_size, stat.st_mtime_ns)
+            if key not in listings: listings[key] = _listArchive(record.path, kind)
+        except Exception as e:
+            errors.append(record.path)
+            logging.warning(f"Could not list archive '{record.path}': {e}")
+            return [record]
+        return [record] + [DBRecord(record.path + "/" + name, size, mtime, 0, DB_DIR if isDir else DB_FILE) for name, size, mtime, isDir in listings[key]]
+
+    def expandBatch(records: list):
+        return list(chain.from_iterable(expand(record) for record in records))
+
+    def unexpanded(records):
+        """Drops the members added by an earlier expansion (paths under a file), so archives are re-listed rather than duplicated."""
+        previous, members = None, None
+        for record in records:
+            if members is not None and record.path.startswith(members): continue
+            members = None
+            if previous is not None and record.path.startswith(previous.path + "/") and \
+               (previous.flags & DB_FILE if previous.flags is not None else os.path.isfile(previous.path)):
+                members = previous.path + "/"
+                continue
+            previous = record
+            yield record
+
+    records = unexpanded(readFlatFileDB(db, metadata = True))
+    batches = iter(lambda: list(islice(records, 1024)), [])
+    tmp = outFile + ".tmp"
+    with alive_bar(title="Expanding archives...", unknown="dots_waves", disable = not verbose) as bar:
+        def expanded():
+            for batch in _orderedMap(expandBatch, batches, threads):
+                bar(len(batch))
+                yield from batch
+        writeFlatFileDB(expanded(), tmp, binary)
+    os.replace(tmp, outFile)
+    _saveCache(cache, listings)
+    if errors: logging.warning(f"{len(errors)} archives could not be listed and were left unexpanded.")
+    return outFile
 
-            tempFile.close()
-            infile.close()
-            os.remove(file)
-            shutil.move(tempFile.name, file)
+def expandZipFlatFileDB(file: str):
+    """Adds the members of the archives in a flat file database to the database. See expandArchivesFlatFileDB.
+    :param file: The path to the DB, which is rewritten
+    :return: The path to the DB
+    """
+    return expandArchivesFlatFileDB(file, verbose = False)
 
 def generateDirTree(dir: list[str], outFile:str = None, startIndex:int = 1):
-    """ Generates an indexed representation of a directory tree
+    """ Generates an indexed representation of a directory tree in a single scandir pass per root
     :param path: The folder to create the directory for
-    :param outFile: The output CSV file
+    :param outFile: The output CSV (or .parquet, requires pyarrow) file, written one root at a time
     :param startIndex: The start index number
-    :return: Dataframe of trees
+    :return: Dataframe of trees, with fileIndex, fileName, path, type (extension or 'Folder'), size (MiB) and isDir columns
     """
     fileIndexCol = "fileIndex"
     fileNameCol = "fileName"
     pathCol = "path"
     fileTypeCol = "type"
     fileSizeCol = "size"
+    isDirCol = "isDir"
     if isinstance(dir, str): dir = [dir] # Coerce str to list   
 
-    # Create tree with a pre-fixed index
-    def pathToDict(path, idx):
-        file_token = ''
-        for root, dirs, files in os.walk(path):
-            files = sorted(files,  key=lambda s: re.sub('[-+]?[0-9]+', '', s)) # Sort but ignore numbers
-            tree = {(str(idx) + "." + str(idx1+1) + "|" + d): pathToDict(os.path.join(root, d),str(idx) + "." + str(idx1+1)) for idx1, d in enumerate(dirs)}
-            tree.update({(str(idx) + "." + str(idx2+1+len(dirs)) + "|" + f): file_token for idx2, f in enumerate(files)})
-            return tree
-
-    # Flatten the keys
-    def getKeys(dl, keys=None):
-        keys = keys or []
-        if isinstance(dl, dict):
-            keys += dl.keys()
-            _ = [getKeys(x, keys) for x in dl.values()]
-        elif isinstance(dl, list):
-            _ = [getKeys(x, keys) for x in dl]
-        return list(set(keys))
-
-    #
-    def keysToPaths(keys, path, idx):
-
-        keys = [str(idx) + "|" + os.path.basename(path)] + keys
-        paths = pd.DataFrame(keys, columns=[pathCol])
-        paths[[fileIndexCol, fileNameCol]] = paths[pathCol].apply(lambda x: pd.Series(str(x).split("|")))
-        sort = sorted(paths[fileIndexCol], key=lambda x: [int(y) for y in x.split('.')])
-        paths = paths.set_index(fileIndexCol).reindex(sort).reset_index().drop(columns=[pathCol])
-        paths[[pathCol]] = path
-        return (paths)
-
-    def addDirectoryNames(paths):
-        for index, row in paths.iterrows():
-            if (index == 0): continue
-            parentIdx = os.path.splitext(row[fileIndexCol])[0]
-            parentRow = paths.loc[paths[fileIndexCol] == parentIdx]
-            paths.at[index,pathCol] = parentRow.iloc[0][pathCol] + "/" + row[fileNameCol]
-        return (paths)
-
-    def addFileTypes(paths):
+    def entrySize(entry):
+        try:
+            return (os.stat(entry) if isinstance(entry, str) else entry.stat()).st_size
+        except OSError:
+            return float("nan")
+
+    # Walk the tree depth-first (directories first, then files), collecting columns. Each path is joined to its parent's path
+    def pathToColumns(path, idx):
+        indexes, names, paths, sizes, isDirs = [str(idx)], [os.path.basename(path)], [path], [entrySize(path)], [os.path.isdir(path)]
+
+        def children(parentPath, parentIndex):
+            dirs, files = [], []
+            for entry in _scanDir(parentPath): (dirs if _isDir(entry) else files).append(entry)
+            files = sorted(files, key=lambda entry: re.sub('[-+]?[0-9]+', '', entry.name)) # Sort but ignore numbers
+            for idx1, entry in enumerate(dirs + files):
+                yield entry, parentPath, parentIndex + "." + str(idx1+1), idx1 < len(dirs)
+
+        stack = [children(path, str(idx))]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None: 
+                stack.pop()
+                continue
+            entry, parentPath, index, isDir = child
+            childPath = parentPath + "/" + entry.name
+            indexes.append(index)
+            names.append(entry.name)
+            paths.append(childPath)
+            sizes.append(entrySize(entry))
+            isDirs.append(isDir)
+            if isDir: stack.append(children(childPath, index))
+
         def custom_ext(name):
-            root, ext = os.path.splitext(name)
-            if ext == '.gz':
-                root, prev_ext = os.path.splitext(root)
-                ext = prev_ext + ext
+            ext = _fileExtension(name)
             return ext if ext else "Folder"
 
-        paths[fileTypeCol] = paths[fileNameCol].apply(custom_ext)
-        #paths[fileTypeCol] = paths[fileNameCol].apply(lambda name: "Folder" if (os.path.splitext(name)[1] == "") else os.path.splitext(name)[1][1:])
-        return(paths)
-
-    def addFileSize(paths):
-        paths[fileSizeCol] = paths[pathCol].apply(lambda path: float("{:.3f}".format(os.stat(path).st_size / (1024 * 1024))))
-        return (paths)
-
-    # Parse to dataframe
-    def pathToDF(path, idx):
-        dic = pathToDict(path, idx)
-        keys = getKeys(dic)
-        paths = keysToPaths(keys,path,idx)
-        paths = addDirectoryNames(paths)
-        paths = addFileTypes(paths) 
-        paths = addFileSize(paths)       
-        return paths
-
-    trees = pd.DataFrame()
+        return pd.DataFrame({fileIndexCol: indexes, fileNameCol: names, pathCol: paths, 
+                             fileTypeCol: [custom_ext(name) for name in names], 
+                             fileSizeCol: [float("{:.3f}".format(size / (1024 * 1024))) for size in sizes],
+                             isDirCol: isDirs})
+
+    trees, writer = [], None
     for idx,path in enumerate(dir):
         print(path)
-        tree = pathToDF(path, idx+startIndex)
+        tree = pathToColumns(path, idx+startIndex)
         if outFile is None:
-            trees = pd.concat([trees,tree], ignore_index=True)
+            trees.append(tree)
+        elif Path(outFile).suffix == ".parquet":
+            import pyarrow, pyarrow.parquet
+            table = pyarrow.Table.from_pandas(tree, preserve_index = False)
+            writer = writer or pyarrow.parquet.ParquetWriter(outFile, table.schema)
+            writer.write_table(table)
         else:
             tree.to_csv(outFile, mode='w' if (idx == 0) else 'a', header= (idx == 0))
+    if writer is not None: writer.close()
 
-    return (trees if outFile is None else outFile)
+    return (pd.concat(trees, ignore_index=True) if trees else pd.DataFrame()) if outFile is None else outFile
 
 def listSubDir(dir: list[str], absolutePath: bool = True, onlyDirs: bool = True, minFolders: int = 2, traverseOrphanDirs: bool = False):
     """Lists all subdirectories in a path. If given a list, all subdirectories for all paths.
@@ -628,7 +2000,8 @@ def str_search(pattern:str, input:list[str], trim:bool = True):
         matches = re.search(pattern, input)
         matches = None if matches == None else matches.string
     elif (type(input) == list):
-        matches = [str_search(pattern, s) for s in input]
+        pattern = re.compile(pattern)
+        matches = [str_search(pattern, s, trim) for s in input]
         if (trim): matches = [m for m in matches if m != None]
     else:
         return None
@@ -646,12 +2019,70 @@ def str_extract(pattern, input, trim = True):
         matches = re.search(pattern, input)
         matches = None if matches == None else matches.group(0)
     elif (type(input) == list):
-        matches = [str_extract(pattern, s) for s in input]
+        pattern = re.compile(pattern)
+        matches = [str_extract(pattern, s, trim) for s in input]
         if (trim): matches = [m for m in matches if m != None]
     else:
         return None
     return matches
              
+def _namedPatterns(patterns, caseSensitive = True):
+    """Compiles a regex, a list of regexes or a dict of name to regex once, as a list of (name, compiled pattern)."""
+    if isinstance(patterns, (str, re.Pattern)): patterns = [patterns]
+    pairs = patterns.items() if isinstance(patterns, dict) else ((getattr(pattern, "pattern", pattern), pattern) for pattern in patterns)
+    flags = 0 if caseSensitive else re.IGNORECASE
+    return [(str(name), re.compile(pattern.pattern, pattern.flags | flags) if isinstance(pattern, re.Pattern) else re.compile(pattern, flags)) for name, pattern in pairs]
+
+def _strManyChunk(args: tuple):
+    """Searches or extracts with each compiled pattern over one chunk of strings, using the vectorized Series.str methods."""
+    extract, patterns, strings = args
+    columns = {}
+    for name, pattern in patterns:
+        if not extract:
+            columns[name] = strings.str.contains(pattern, na = False)
+        elif pattern.groups == 0: # Wrapping the pattern in a group would break leading inline flags
+            columns[name] = strings.map(lambda string: match.group(0) if isinstance(string, str) and (match := pattern.search(string)) else float("nan"))
+        else:
+            groups = strings.str.extract(pattern, expand = True)
+            for group in groups.columns:
+                named = isinstance(group, str) and len(patterns) == 1 # Named groups of different patterns could share a name
+                columns[group if named else f"{name}_{group if isinstance(group, str) else group + 1}"] = groups[group]
+    return pd.DataFrame(columns, index = strings.index)
+
+def _strMany(extract: bool, patterns, input, caseSensitive = True, processes: int = None, chunkSize: int = 100000):
+    patterns = _namedPatterns(patterns, caseSensitive)
+    if isinstance(input, str): input = readFlatFileDB(input)
+    strings = input if isinstance(input, pd.Series) else pd.Series(list(input), dtype = object)
+    if processes is None or processes <= 1 or len(strings) <= chunkSize:
+        return _strManyChunk((extract, patterns, strings))
+    chunks = ((extract, patterns, strings.iloc[start:start + chunkSize]) for start in range(0, len(strings), chunkSize))
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        return pd.concat(executor.map(_strManyChunk, chunks))
+
+def str_search_many(patterns, input, caseSensitive = True, processes: int = None, chunkSize: int = 100000):
+    """Searches many strings for several regular expressions at once. Each pattern is compiled once
+    :param patterns: A regular expression, a list of them, or a dict of name to regular expression
+    :param input: The strings to search: a list, a pandas Series, or the path to a flat file database
+    :param caseSensitive: Is case important?, defaults to True
+    :param processes: Number of processes to search chunks of the strings with, defaults to 1
+    :param chunkSize: Number of strings per chunk when using processes
+    :return: A DataFrame aligned with the input, with a boolean column per pattern (named by its key, or the pattern itself)
+    """
+    return _strMany(False, patterns, input, caseSensitive, processes, chunkSize)
+
+def str_extract_many(patterns, input, caseSensitive = True, processes: int = None, chunkSize: int = 100000):
+    """Extracts several regular expressions from many strings at once (e.g. sample, run and lane from paths). Each pattern is compiled once
+    :param patterns: A regular expression, a list of them, or a dict of name to regular expression
+    :param input: The strings to search: a list, a pandas Series, or the path to a flat file database
+    :param caseSensitive: Is case important?, defaults to True
+    :param processes: Number of processes to extract from chunks of the strings with, defaults to 1
+    :param chunkSize: Number of strings per chunk when using processes
+    :return: A DataFrame aligned with the input. Patterns with capture groups give a column per group (named groups keep
+             their names for a single pattern, others are '<pattern name>_<group name or number>'); patterns without give a
+             column of the whole match. NaN where there is no match
+    """
+    return _strMany(True, patterns, input, caseSensitive, processes, chunkSize)
+
 def parseExtensions(dir: str, maxFiles = 100000): 
     """Gets all extensions from a target directory
     :param targetDir: The path to the target directory
@@ -698,27 +2129,58 @@ def parseExtensions(dir: str, maxFiles = 100000):
 
 #     os.system("bash -c '%s'" % script)
 
-def suction(dir:list[str], excludeDirs: list[str] = []):
-    """Moves all files within the specified directory to the root dir, then deletes all the folders
+def planSuction(dir: str, excludeDirs: list[str] = [], threads: int = 1):
+    """Plans suction from a single listing of the tree, without touching the filesystem again. Names that clash at the
+    root are made unique ('name.1.ext', 'name.2.ext', ...) from an in-memory registry, in sorted path order.
+    :param dir: The directory to suction
+    :param excludeDirs: Names of directories to leave in place, with their contents
+    :param threads: The number of directories to list concurrently
+    :return: A list of (operation, source, destination) steps for executeMovePlan
+    """
+    if isinstance(excludeDirs, str): excludeDirs = [excludeDirs]
+    excludeDirs = set(excludeDirs)
+    top = _scanDir(dir)
+    names = {entry.name for entry in top}
+    kept = set() # Directories that will still hold excluded directories
+
+    def scan(path, depth):
+        files, subdirs = [], []
+        for entry in _scanDir(path):
+            if entry.is_symlink() or not _isDir(entry): files.append(entry.path)
+            elif entry.name in excludeDirs: kept.add(path)
+            else: subdirs.append(entry.path)
+        return [(path, files)], subdirs
+
+    roots = [entry.path for entry in top if not entry.is_symlink() and _isDir(entry) and entry.name not in excludeDirs]
+    listing = dict(chain.from_iterable(_walkTree(roots, scan, threads)))
+
+    plan, counters = [], defaultdict(lambda: 1)
+    for file in sorted(chain.from_iterable(listing.values())):
+        name = os.path.basename(file)
+        if name in names:
+            base, ext = os.path.splitext(name)
+            while name in names:
+                name = f"{base}.{counters[base, ext]}{ext}"
+                counters[base, ext] += 1
+        names.add(name)
+        plan.append(("move", file, os.path.join(dir, name)))
+
+    for path in list(kept): # Keep the ancestors of excluded directories too
+        while (path := os.path.dirname(path)) not in kept and path != dir and len(path) > len(dir): kept.add(path)
+    plan += [("rmdir", path, None) for path in sorted(listing, key = lambda path: path.count(os.sep), reverse = True) if path not in kept]
+    return plan
+
+def suction(dir: str, excludeDirs: list[str] = [], threads: int = 8, dry_run = False):
+    """Moves all files within the specified directory to the root dir, then deletes all the emptied folders
     :param dir: The directory to suction
     :param excludeDirs: A list of directories to ignore
-    """    
-    import shutil
-
-    for root, dirs, files in os.walk(dir, topdown=True, followlinks=False):
-        dirs[:] = [d for d in dirs if d not in excludeDirs]
-        if (root == dir): continue
-        for file in files:
-            filename = file
-            idx = 1
-            while (os.path.exists(os.path.join(dir, filename))):
-                print(f"Duplicate file found for {file}")
-                (name,ext) = os.path.splitext(file)
-                filename = name + f".{idx}" + ext
-            os.rename(os.path.join(root, file), os.path.join(root, filename))            
-            shutil.move(os.path.join(root, filename), dir)
-
-    [shutil.rmtree(os.path.join(dir,d)) for d in next(os.walk(dir))[1]]
+    :param threads: Number of directories to list and files to move concurrently, defaults to 8
+    :param dry_run: Only log the steps?, defaults to False
+    :return: A dict of the old to the new path of each file moved
+    """
+    plan = planSuction(dir, excludeDirs, threads)
+    failed = {step[1] for _, step, _ in executeMovePlan(plan, threads = threads, dry_run = dry_run)}
+    return {src: dst for op, src, dst in plan if op == "move" and src not in failed}
 
 def sigfig(val, n:int = 3):
     """Forces value to specific number of decimal points
@@ -782,6 +2244,47 @@ def convertLinuxDBtoWindows(dbPath, newPath, replace):
                 for rep in replace: ln = ln.replace(rep[0],rep[1])
                 newDB.write(ln)
 
+def compilePathMap(mapping, sep: str = None):
+    """Compiles mount prefix mappings (e.g. {'/mnt/data': 'Z:'}) once into a function that rewrites paths. Prefixes only
+    match whole path components, and the longest matching prefix wins.
+    :param mapping: A dict or list of (prefix, replacement) pairs
+    :param sep: The separator to use in the rewritten paths (e.g. '\\' for Windows, '/' for Linux), defaults to leaving them as-is
+    :return: A function mapping a path to its rewritten path. Paths without a matching prefix only have their separators changed
+    """
+    pairs = mapping.items() if isinstance(mapping, dict) else mapping
+    prefixes = {prefix.rstrip("/\\"): replacement.rstrip("/\\") for prefix, replacement in pairs} # '/' becomes '', matching any absolute path
+    lengths = sorted({len(prefix) for prefix in prefixes}, reverse = True)
+    separators = None if sep is None else str.maketrans({"/": sep, "\\": sep})
+
+    def mapPath(path: str):
+        for length in lengths:
+            if length > len(path) or (prefix := path[:length]) not in prefixes: continue
+            if len(path) == length or path[length] in "/\\":
+                path = prefixes[prefix] + path[length:]
+                break
+        return path if separators is None else path.translate(separators)
+    return mapPath
+
+def _pathMapper(pathMap):
+    """Returns pathMap if it is already compiled, otherwise compiles it with compilePathMap."""
+    return pathMap if callable(pathMap) else compilePathMap(pathMap)
+
+def exportMappedFlatFileDB(db: str, outFile: str, pathMap, verbose = True):
+    """Streams a flat file database to a new database with its paths rewritten (e.g. Linux mounts to Windows drives).
+    :param db: The path to the DB, or a list of paths/DBRecords
+    :param outFile: The output DB file. Binary DBs stay binary
+    :param pathMap: The prefix mappings, as for compilePathMap, or a function from compilePathMap
+    :param verbose: Show the progress bar?
+    :return: The path to the output DB file
+    """
+    mapPath = _pathMapper(pathMap)
+    with alive_bar(title="Exporting...", unknown="dots_waves", disable = not verbose) as bar:
+        def mapped():
+            for record in readFlatFileDB(db, metadata = True):
+                bar()
+                yield record._replace(path = mapPath(record.path))
+        return writeFlatFileDB(mapped(), outFile, isBinaryDB(db) if isinstance(db, str) else None)
+
 def collapseNumbers(numbers: list[str]):
     """Collapses a list of numbered strings into a list
     :param numbers: List of strings with some iterating number
@@ -3,9 +3,11 @@ Unit tests for functions from searchTools.
 
 To run, use: python -m unittest tests.test_searchTools
 """
-import unittest, os, shutil, tempfile, pathlib
+import unittest, os, io, sys, array, shutil, tempfile, pathlib, gzip, pickle
+from unittest import mock
+import pandas as pd
 
-from searchTools import findNestedDirs, flattenDirectory
+from searchTools import findNestedDirs, flattenDirectory, generateFlatFileDB, readFlatFileDB, filterFileClass, searchFlatFileDB, batchSearchFlatFileDB, generateTrigramIndex, generateMLookupDB, mlocateFile, findFiles, findFile, generateChecksumManifest, verifyChecksumManifest, findDuplicateFiles, compressFiles, planMoves, splitFolder, moveFileInTree, sampleAndCopyFiles, generateDirTree, rollupFlatFileDB, extensionInventory, expandArchivesFlatFileDB, flattenAndPruneDirectory, planFlattenAndPrune, executeMovePlan, suction, compilePathMap, exportMappedFlatFileDB, str_search, str_search_many, str_extract_many, generateSearchAutomaton, clearAutomatonCache, DBRecord, DB_DIR, isBinaryDB, writeFlatFileDB
 
 
 class TestNestedFolderUtils(unittest.TestCase):
@@ -43,8 +45,450 @@ class TestNestedFolderUtils(unittest.TestCase):
         self.assertTrue(os.path.exists(os.path.join(self.test_dir, "test.txt")))
         self.assertFalse(os.path.exists(os.path.join(self.test_dir, "dir1", "dir2")))
 
+    def test_flattenAndPruneDirectory(self):
+        os.makedirs(os.path.join(self.test_dir, "dir1", "dir2", "dir2"))
+        os.makedirs(os.path.join(self.test_dir, "dir1", "empty", "empty"))
+        pathlib.Path(self.test_dir, "dir1", "dir2", "dir2", "dir2").write_text("test content")
+        plan = flattenAndPruneDirectory(self.test_dir, dry_run = True)
+        self.assertEqual(plan, planFlattenAndPrune(self.test_dir))
+        self.assertTrue(os.path.exists(os.path.join(self.test_dir, "dir1", "empty", "empty")))
+        flattenAndPruneDirectory(self.test_dir, threads = 2)
+        self.assertEqual(pathlib.Path(self.test_dir, "dir2", "dir2_1").read_text(), "test content")
+        self.assertEqual(os.listdir(self.test_dir), ["dir2"])
 
-if __name__ == "__main__":
-    unittest.main()
+    def test_flattenAndPruneDirectory_symlink(self):
+        os.makedirs(os.path.join(self.test_dir, "target"))
+        root = os.path.join(self.test_dir, "root")
+        for _ in range(20): # The unlink and the move of its parent used to race
+            os.makedirs(os.path.join(root, "A", "P"))
+            os.makedirs(os.path.join(root, "A", "Q"))
+            os.symlink(os.path.join(self.test_dir, "target"), os.path.join(root, "A", "P", "L"))
+            pathlib.Path(root, "A", "Q", "f").write_text("test content")
+            plan = planFlattenAndPrune(root)
+            ops = [op for op, _, _ in plan]
+            self.assertIn(ops[ops.index("unlink") + 1], ["barrier", "rmdir"]) # The unlink never shares a batch with the moves
+            self.assertEqual(executeMovePlan(plan, threads = 8), [])
+            self.assertEqual(os.listdir(root), ["Q"])
+            shutil.rmtree(root)
+
+    def test_suction(self):
+        for file in ["test.txt", "dir1/test.txt", "dir1/dir2/test.txt", "dir1/keep/test.txt"]:
+            pathlib.Path(self.test_dir, file).parent.mkdir(parents = True, exist_ok = True)
+            pathlib.Path(self.test_dir, file).write_text(file)
+        moved = suction(self.test_dir, excludeDirs = ["keep"], threads = 2)
+        self.assertEqual({os.path.relpath(src, self.test_dir): os.path.relpath(dst, self.test_dir) for src, dst in moved.items()},
+                         {os.path.join("dir1", "dir2", "test.txt"): "test.1.txt", os.path.join("dir1", "test.txt"): "test.2.txt"})
+        self.assertEqual(pathlib.Path(self.test_dir, "test.2.txt").read_text(), "dir1/test.txt")
+        self.assertTrue(os.path.exists(os.path.join(self.test_dir, "dir1", "keep", "test.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, "dir1", "dir2")))
+
+
+class TestFlatFileDB(unittest.TestCase):
+    """
+    Unit tests for functions pertaining to generating/searching flat file databases.
+    """
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.test_dir, "run1", "fastq"))
+        os.makedirs(os.path.join(self.test_dir, "run2"))
+        for file in [("run1", "SampleSheet.csv"), ("run1", "fastq", "S1_R1.fastq.gz"), ("run2", "S2_R1.fastq.gz")]:
+            pathlib.Path(self.test_dir, *file).write_text("test content")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_generateFlatFileDB_threaded(self):
+        expected = [os.path.join(root, item) for root, dirs, files in os.walk(self.test_dir) for item in files + dirs]
+        self.assertEqual(generateFlatFileDB(self.test_dir, verbose = False), expected)
+        self.assertEqual(sorted(generateFlatFileDB(self.test_dir, verbose = False, threads = 4)), sorted(expected))
+
+    def test_binaryDB(self):
+        db = generateFlatFileDB(self.test_dir, os.path.join(self.test_dir, "db.bin"), verbose = False, binary = True)
+        text = generateFlatFileDB(self.test_dir, verbose = False)
+        self.assertEqual(sorted(readFlatFileDB(db)), sorted(text))
+        records = {record.path: record for record in readFlatFileDB(db, metadata = True)}
+        self.assertEqual(records[os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz")].size, len("test content"))
+        self.assertEqual(sorted(filterFileClass(db, "folder", inclusive = True)), sorted(filterFileClass(text, "folder", inclusive = True)))
+        out = os.path.join(tempfile.mkdtemp(), "out.bin")
+        searchFlatFileDB(db, out, searchTerms = "nothing", verbose = False) # No matches still gives a binary DB
+        self.assertTrue(isBinaryDB(out))
+        self.assertEqual(list(readFlatFileDB(out)), [])
+        shutil.rmtree(os.path.dirname(out))
+
+    def test_generateFlatFileDB_update(self):
+        db = os.path.join(tempfile.mkdtemp(), "db.txt")
+        generateFlatFileDB(self.test_dir, db, verbose = False, update = True)
+        os.makedirs(os.path.join(self.test_dir, "run3"))
+        os.remove(os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz"))
+        generateFlatFileDB(self.test_dir, db, verbose = False, update = True)
+        self.assertEqual(sorted(readFlatFileDB(db)), sorted(generateFlatFileDB(self.test_dir, verbose = False)))
+        shutil.rmtree(os.path.dirname(db))
+
+    def test_searchFlatFileDB(self):
+        db = generateFlatFileDB(self.test_dir, verbose = False)
+        expected = [os.path.join(self.test_dir, "run1", "fastq", "S1_R1.fastq.gz")]
+        self.assertEqual(searchFlatFileDB(db, searchTerms = ["fastq.gz$"], excludeTerms = "run2", verbose = False), expected)
+        self.assertEqual(list(searchFlatFileDB(db, searchTerms = "S1", includeTerms = ["r1", "r2"], stream = True)), expected)
+
+    def test_searchFlatFileDB_processes(self):
+        db = generateFlatFileDB(self.test_dir, os.path.join(tempfile.mkdtemp(), "db.txt"), verbose = False)
+        serial = searchFlatFileDB(db, searchTerms = "r1", verbose = False)
+        self.assertEqual(searchFlatFileDB(db, searchTerms = "r1", verbose = False, processes = 2), serial)
+        shutil.rmtree(os.path.dirname(db))
+
+    def test_batchSearchFlatFileDB(self):
+        db = generateFlatFileDB(self.test_dir, verbose = False)
+        found = batchSearchFlatFileDB(db, ["S1_", "s2_", "S3_"], verbose = False)
+        self.assertEqual(found["S1_"], [os.path.join(self.test_dir, "run1", "fastq", "S1_R1.fastq.gz")])
+        self.assertEqual(found["s2_"], [os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz")])
+        self.assertEqual(found["S3_"], [])
+        self.assertEqual(batchSearchFlatFileDB(db, [], verbose = False), {})
+        self.assertTrue(batchSearchFlatFileDB(db, [], asDataFrame = True, verbose = False).empty)
+
+    def test_searchFlatFileDB_trigramIndex(self):
+        db = generateFlatFileDB(self.test_dir, os.path.join(tempfile.mkdtemp(), "db.txt"), verbose = False)
+        generateTrigramIndex(db, verbose = False)
+        for terms in [{"searchTerms": "s1_r1"}, {"searchTerms": "^" + self.test_dir, "includeTerms": ["SampleSheet", "xyz"]}, {"searchTerms": "nothing"}]:
+            self.assertEqual(searchFlatFileDB(db, verbose = False, **terms), searchFlatFileDB(db, verbose = False, useIndex = False, **terms))
+        shutil.rmtree(os.path.dirname(db))
+
+    def test_trigramCandidates_skipsLargePostings(self):
+        module = sys.modules[generateTrigramIndex.__module__]
+        many = os.path.join(self.test_dir, "many")
+        os.makedirs(many)
+        for idx in range(200): pathlib.Path(many, f"sample_{idx}.txt").touch()
+        pathlib.Path(many, "unique_qzx.txt").touch()
+        db = generateFlatFileDB(self.test_dir, os.path.join(tempfile.mkdtemp(), "db.txt"), verbose = False)
+        generateTrigramIndex(db, verbose = False)
+        chunked = generateTrigramIndex(db, db + ".chunked", verbose = False, chunkSize = 7) # Merged from 30 runs
+        with open(db + ".tri", "rb") as whole, open(chunked, "rb") as merged: self.assertEqual(whole.read(), merged.read())
+        generateTrigramIndex(db, chunked, verbose = False, chunkSize = 7, processes = 2)
+        with open(db + ".tri", "rb") as whole, open(chunked, "rb") as merged: self.assertEqual(whole.read(), merged.read())
+        self.assertEqual(sorted(os.listdir(os.path.dirname(db))), sorted(["db.txt", "db.txt.tri", "db.txt.chunked"]))
+
+        loaded = []
+        class CountingArray(array.array):
+            def frombytes(self, data):
+                loaded.append(len(data) // self.itemsize)
+                super().frombytes(data)
+        with mock.patch.object(module, "array", CountingArray):
+            offsets, binary = module._trigramCandidates(db, ["unique_qzx.txt"], [])
+        self.assertEqual(len(offsets), 1)
+        self.assertLess(max(loaded), 10) # Trigrams shared by every path (e.g. ".tx") are never read
+        self.assertEqual(searchFlatFileDB(db, searchTerms = "unique_qzx", verbose = False), [os.path.join(many, "unique_qzx.txt")])
+        shutil.rmtree(os.path.dirname(db))
+
+    def test_mlocateFile(self):
+        db = generateMLookupDB(self.test_dir, os.path.join(tempfile.mkdtemp(), "locate.db"), excludeDirs = ["fastq"])
+        expected = os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz") + "\n"
+        self.assertEqual(mlocateFile("S2_R1", db), expected)
+        self.assertEqual(mlocateFile(["*.fastq.gz", "S1_R1"], db), {"*.fastq.gz": expected, "S1_R1": None})
+        shutil.rmtree(os.path.dirname(db))
+
+    def test_findFiles(self):
+        fastqs = [os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz"), os.path.join(self.test_dir, "run1", "fastq", "S1_R1.fastq.gz")]
+        self.assertEqual(sorted(findFiles("fastq", target_directory = self.test_dir, threads = 2)), sorted(fastqs))
+        self.assertEqual(list(findFiles("fastq", target_directory = self.test_dir, maxDepth = 1)), fastqs[:1])
+        self.assertEqual(len(list(findFiles("fastq", target_directory = self.test_dir, limit = 1))), 1)
+        self.assertEqual(findFile("SampleSheet", target_directory = self.test_dir), os.path.join(self.test_dir, "run1", "SampleSheet.csv"))
+
+    def test_checksumManifest(self):
+        out_dir = tempfile.mkdtemp()
+        db = generateFlatFileDB(self.test_dir, verbose = False)
+        manifest = generateChecksumManifest(db, os.path.join(out_dir, "manifest.md5"), threads = 2, cache = os.path.join(out_dir, "cache.pkl"), verbose = False)
+        pathlib.Path(self.test_dir, "run2", "S2_R1.fastq.gz").write_text("changed")
+        status = verifyChecksumManifest(manifest, cache = os.path.join(out_dir, "cache.pkl"), verbose = False).set_index("path")["status"]
+        self.assertEqual(status[os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz")], "FAILED")
+        self.assertEqual(status[os.path.join(self.test_dir, "run1", "SampleSheet.csv")], "OK")
+        shutil.rmtree(out_dir)
+
+    def test_findDuplicateFiles(self):
+        pathlib.Path(self.test_dir, "run2", "S2_R1.fastq.gz").write_text("other content")
+        duplicates = findDuplicateFiles(generateFlatFileDB(self.test_dir, verbose = False), sampleSize = 4, threads = 2, verbose = False)
+        expected = [os.path.join(self.test_dir, "run1", "SampleSheet.csv"), os.path.join(self.test_dir, "run1", "fastq", "S1_R1.fastq.gz")]
+        self.assertEqual(sorted(duplicates["path"]), sorted(expected))
+        self.assertEqual(set(duplicates["group"]), {1})
+
+    def test_compressFiles(self):
+        file = pathlib.Path(self.test_dir, "run1", "SampleSheet.csv")
+        file.write_text("Sample_ID,Lane\n" * 1000)
+        report = compressFiles([str(file)], processes = 1, threads = 2, blockSize = 1024, verbose = False)
+        self.assertTrue(report["verified"].all())
+        self.assertFalse(file.exists())
+        with gzip.open(str(file) + ".gz", "rt") as f: self.assertEqual(f.read(), "Sample_ID,Lane\n" * 1000)
+
+        # One missing file doesn't abort the batch
+        fastq, missing = os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz"), os.path.join(self.test_dir, "missing.txt")
+        report = compressFiles([missing, fastq], processes = 2, threads = 1, verbose = False).set_index("file")
+        self.assertTrue(pd.isna(report.loc[missing, "output"]))
+        self.assertIn("missing.txt", report.loc[missing, "error"])
+        self.assertFalse(os.path.exists(missing + ".gz"))
+        self.assertEqual(report.loc[fastq, "output"], fastq + ".gz")
+        self.assertTrue(pd.isna(report.loc[fastq, "error"]))
+
+    def test_compressFiles_inFlight(self):
+        module = sys.modules[compressFiles.__module__]
+        file = pathlib.Path(self.test_dir, "run1", "SampleSheet.csv")
+        file.write_text("Sample_ID,Lane\n" * 1000)
+        pulled, written, maxInFlight = 0, 0, 0
+        compress = module.gzip.compress
+        def counting(block, **kwargs):
+            nonlocal pulled, maxInFlight
+            pulled += 1
+            maxInFlight = max(maxInFlight, pulled - written)
+            return compress(block, **kwargs)
+        class CountingFile(io.BytesIO):
+            def write(self, data):
+                nonlocal written
+                written += 1
+        with mock.patch.object(module.gzip, "compress", counting), mock.patch.object(module, "open", side_effect = lambda name, mode: CountingFile() if "w" in mode else open(name, mode)):
+            module._gzipBlocks(str(file), str(file) + ".gz", 6, 256, 2)
+        self.assertGreater(written, 10)
+        self.assertLessEqual(maxInFlight, 3)
+
+    def test_splitFolder(self):
+        source, dest = os.path.join(self.test_dir, "run1"), os.path.join(self.test_dir, "run1_split")
+        files = [os.path.join(source, "fastq", "S1_R1.fastq.gz"), os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz")]
+        plan = planMoves(files, source, dest)
+        self.assertEqual([op for op, _, _ in plan], ["mkdir", "move", "rmdir"])
+        journal = os.path.join(tempfile.mkdtemp(), "journal")
+        splitFolder(files, source, dest, dry_run = False, journal = journal)
+        self.assertTrue(os.path.exists(os.path.join(dest, "fastq", "S1_R1.fastq.gz")))
+        self.assertFalse(os.path.exists(os.path.join(source, "fastq")))
+        self.assertTrue(os.path.exists(files[1]))
+        self.assertFalse(os.path.exists(journal))
+        self.assertEqual(splitFolder(files, source, dest, dry_run = False, journal = journal), [])
+        shutil.rmtree(os.path.dirname(journal))
+
+    def test_splitFolder_journal(self):
+        source, dest = self.test_dir, os.path.join(tempfile.mkdtemp(), "split")
+        sheet, fastq = os.path.join(source, "run1", "SampleSheet.csv"), os.path.join(source, "run2", "S2_R1.fastq.gz")
+        journal = os.path.join(os.path.dirname(dest), "journal")
+        splitFolder([sheet], source, dest, dry_run = False, journal = journal)
+        splitFolder([fastq], source, dest, dry_run = False, journal = journal)
+        self.assertTrue(os.path.exists(os.path.join(dest, "run2", "S2_R1.fastq.gz")))
+
+        os.makedirs(os.path.join(dest, "run1", "fastq", "S1_R1.fastq.gz")) # Blocks the move, leaving the journal unfinished
+        fastq = os.path.join(source, "run1", "fastq", "S1_R1.fastq.gz")
+        self.assertEqual(len(splitFolder([fastq], source, dest, dry_run = False, journal = journal)), 1)
+        self.assertTrue(os.path.exists(journal))
+        with self.assertRaises(ValueError): splitFolder([sheet], source, dest, dry_run = False, journal = journal)
+        with self.assertRaises(OSError): moveFileInTree(fastq, source, dest)
+        self.assertTrue(os.path.exists(fastq))
+        shutil.rmtree(os.path.dirname(dest))
+
+    def test_sampleAndCopyFiles(self):
+        dest = tempfile.mkdtemp()
+        selected = sampleAndCopyFiles(self.test_dir, dest, numFiles = 1, dry_run = False, stratify = "dir")
+        self.assertEqual(sorted(os.path.relpath(file, self.test_dir).split(os.sep)[0] for file in selected), ["run1", "run2"])
+        for file in selected:
+            self.assertEqual(pathlib.Path(dest, os.path.relpath(file, self.test_dir)).read_text(), "test content")
+        self.assertEqual(len(sampleAndCopyFiles(self.test_dir, dest, numFiles = 10)), 3)
+        shutil.rmtree(dest)
+
+    def test_sampleAndCopyFiles_seeded(self):
+        import random
+        for idx in range(20):
+            os.makedirs(os.path.join(self.test_dir, "many", f"dir{idx}"))
+            for file in range(5): pathlib.Path(self.test_dir, "many", f"dir{idx}", f"file{file}.txt").touch()
+        selections = []
+        for _ in range(5):
+            random.seed(0)
+            with mock.patch("builtins.print"): selections.append(sampleAndCopyFiles(self.test_dir, os.path.join(self.test_dir, "dest"), numFiles = 10))
+        self.assertEqual(len({tuple(selection) for selection in selections}), 1)
 
+    def test_generateDirTree(self):
+        tree = generateDirTree(os.path.join(self.test_dir, "run1"))
+        self.assertEqual(list(tree["fileIndex"]), ["1", "1.1", "1.1.1", "1.2"])
+        self.assertEqual(list(tree["path"]), [os.path.join(self.test_dir, *parts) for parts in [("run1",), ("run1", "fastq"), ("run1", "fastq", "S1_R1.fastq.gz"), ("run1", "SampleSheet.csv")]])
+        self.assertEqual(list(tree["type"]), ["Folder", "Folder", ".fastq.gz", ".csv"])
+        self.assertEqual(list(tree["isDir"]), [True, True, False, False])
+        self.assertEqual(tree["size"].iloc[-1], 0.0)
 
+    def test_rollupFlatFileDB(self):
+        db = generateFlatFileDB(self.test_dir, os.path.join(tempfile.mkdtemp(), "db.bin"), verbose = False, binary = True)
+        rollup = rollupFlatFileDB(db).set_index("dir")
+        self.assertEqual(rollup.loc[self.test_dir, ["depth", "files", "size"]].tolist(), [0, 3, 36])
+        self.assertEqual(rollup.loc[os.path.join(self.test_dir, "run1"), ["depth", "files", "size"]].tolist(), [1, 2, 24])
+        self.assertEqual(len(rollupFlatFileDB(db, maxDepth = 0)), 1)
+        byExtension = rollupFlatFileDB(db, maxDepth = 0, byExtension = True)
+        self.assertEqual(byExtension[["extension", "files"]].values.tolist(), [[".csv", 1], [".fastq.gz", 2]])
+        self.assertEqual(extensionInventory(db)[["extension", "files", "size"]].values.tolist(), [[".fastq.gz", 2, 24], [".csv", 1, 12]])
+        shutil.rmtree(os.path.dirname(db))
+
+        # Directories but no files
+        empty_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(empty_dir, "run1", "fastq"))
+        for binary in [True, False]:
+            db = generateFlatFileDB(empty_dir, os.path.join(tempfile.mkdtemp(), "db"), verbose = False, binary = binary)
+            self.assertIn(os.path.join(empty_dir, "run1"), rollupFlatFileDB(db)["dir"].tolist())
+            self.assertEqual(len(rollupFlatFileDB(db, byExtension = True)), 1 - binary) # Text DBs can't tell an empty leaf directory from a file
+            self.assertEqual(extensionInventory(db)["files"].sum(), 1 - binary)
+            shutil.rmtree(os.path.dirname(db))
+        self.assertEqual(rollupFlatFileDB([DBRecord(os.path.join(empty_dir, "run1"), 0, 0, 0, DB_DIR)])["files"].tolist(), [0])
+        self.assertEqual(rollupFlatFileDB([]).empty, True)
+        shutil.rmtree(empty_dir)
+
+        # Extensionless files and dotted directories in generateDirTree frames
+        proj = os.path.join(self.test_dir, "proj")
+        os.makedirs(os.path.join(proj, "run.2023"))
+        for name in ["README", "Makefile", "x.csv", "run.2023/a.txt", "run.2023/b.txt"]: pathlib.Path(proj, name).touch()
+        rollup = rollupFlatFileDB(generateDirTree(proj)).set_index("dir")
+        self.assertEqual(rollup.loc[proj, "files"], 5)
+        self.assertEqual(rollup.loc[os.path.join(proj, "run.2023"), "files"], 2)
+        self.assertNotIn(os.path.join(proj, "README"), rollup.index)
+        self.assertEqual(sorted(extensionInventory(generateDirTree(proj))["extension"]), ["", ".csv", ".txt"])
+
+        # Files directly under the root
+        rollup = rollupFlatFileDB([DBRecord("/x", 1, 0, 0, 1), DBRecord("/y", 2, 0, 0, 1)])
+        self.assertEqual(rollup[["dir", "depth", "files", "size"]].values.tolist(), [["/", 0, 2, 3]])
+
+
+    def test_expandArchivesFlatFileDB(self):
+        import zipfile, tarfile
+        with zipfile.ZipFile(os.path.join(self.test_dir, "run1", "bundle.zip"), "w") as archive: archive.writestr("reads/S3_R1.fastq.gz", "test content")
+        with tarfile.open(os.path.join(self.test_dir, "run2", "bundle.tar.gz"), "w:gz") as archive: archive.add(os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz"), "S4_R1.fastq.gz")
+        out_dir = tempfile.mkdtemp()
+        db = generateFlatFileDB(self.test_dir, os.path.join(out_dir, "db.bin"), verbose = False, binary = True)
+        expandArchivesFlatFileDB(db, cache = os.path.join(out_dir, "archives.pkl"), threads = 2, verbose = False)
+        records = {record.path: record for record in readFlatFileDB(db, metadata = True)}
+        self.assertEqual(records[os.path.join(self.test_dir, "run1", "bundle.zip", "reads", "S3_R1.fastq.gz")].size, 12)
+        self.assertIn(os.path.join(self.test_dir, "run2", "bundle.tar.gz", "S4_R1.fastq.gz"), records)
+        with open(os.path.join(out_dir, "archives.pkl"), "rb") as f: self.assertEqual(len(pickle.load(f)), 2)
+
+        # Re-running neither duplicates members nor lists members as archives
+        with zipfile.ZipFile(os.path.join(self.test_dir, "run1", "bundle.zip"), "a") as archive: archive.writestr("inner.zip", b"")
+        for binary in [True, False]:
+            db = generateFlatFileDB(self.test_dir, os.path.join(out_dir, "db"), verbose = False, binary = binary)
+            expandArchivesFlatFileDB(db, threads = 2, verbose = False)
+            once = list(readFlatFileDB(db, metadata = True))
+            self.assertIn(os.path.join(self.test_dir, "run1", "bundle.zip", "inner.zip"), [record.path for record in once])
+            with self.assertNoLogs(level = "WARNING"): expandArchivesFlatFileDB(db, threads = 2, verbose = False)
+            self.assertEqual(list(readFlatFileDB(db, metadata = True)), once)
+        shutil.rmtree(out_dir)
+
+
+    def test_filterFileClass_predicates(self):
+        pathlib.Path(self.test_dir, "run2", "S2_R1.fastq.gz").write_text("more test content")
+        os.symlink(os.path.join(self.test_dir, "run2"), os.path.join(self.test_dir, "run2_link"))
+        text = generateFlatFileDB(self.test_dir, os.path.join(tempfile.mkdtemp(), "db.txt"), verbose = False)
+        binary = generateFlatFileDB(self.test_dir, os.path.join(tempfile.mkdtemp(), "db.bin"), verbose = False, binary = True)
+        cache = {}
+        for db in [text, binary]:
+            large = filterFileClass(db, "file", inclusive = True, minSize = 13, extensions = ".fastq.gz", threads = 2, cache = cache)
+            self.assertEqual(large, [os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz")])
+            self.assertEqual(filterFileClass(db, "symlink", inclusive = True, cache = cache), [os.path.join(self.test_dir, "run2_link")])
+            self.assertEqual(len(filterFileClass(db, None, inclusive = True, modifiedBefore = 0)), 0)
+        self.assertEqual(len(cache), 7)
+        shutil.rmtree(os.path.dirname(text))
+        shutil.rmtree(os.path.dirname(binary))
+
+
+    def test_pathMap(self):
+        pathMap = compilePathMap({self.test_dir: "Z:", os.path.join(self.test_dir, "run1", "fastq"): "F:"}, sep = "\\")
+        db = generateFlatFileDB(self.test_dir, os.path.join(tempfile.mkdtemp(), "db.bin"), verbose = False, binary = True)
+        self.assertEqual(sorted(searchFlatFileDB(db, searchTerms = "fastq.gz", pathMap = pathMap, verbose = False)), ["F:\\S1_R1.fastq.gz", "Z:\\run2\\S2_R1.fastq.gz"])
+        self.assertEqual(batchSearchFlatFileDB(db, ["S2_"], pathMap = pathMap, verbose = False), {"S2_": ["Z:\\run2\\S2_R1.fastq.gz"]})
+        exported = exportMappedFlatFileDB(db, db + ".windows", pathMap, verbose = False)
+        self.assertEqual([record.size for record in readFlatFileDB(exported, metadata = True)], [record.size for record in readFlatFileDB(db, metadata = True)])
+        self.assertIn("Z:\\run1\\SampleSheet.csv", list(readFlatFileDB(exported)))
+        empty = writeFlatFileDB([], db + ".empty", binary = True)
+        self.assertTrue(isBinaryDB(exportMappedFlatFileDB(empty, empty + ".windows", pathMap, verbose = False)))
+        self.assertEqual(compilePathMap({self.test_dir: "Z:"})(self.test_dir + "_other"), self.test_dir + "_other")
+        shutil.rmtree(os.path.dirname(db))
+
+
+    def test_str_many(self):
+        paths = ["/runs/Run7/S1_L001_R1.fastq.gz", "/runs/Run8/S22_L002_R2.fastq.gz", "/runs/README"]
+        fields = str_extract_many(r"Run(?P<run>\d+)/S(?P<sample>\d+)_L(?P<lane>\d+)", paths)
+        self.assertEqual(fields.iloc[:2].values.tolist(), [["7", "1", "001"], ["8", "22", "002"]])
+        self.assertTrue(fields.iloc[2].isna().all())
+        db = generateFlatFileDB(self.test_dir, os.path.join(tempfile.mkdtemp(), "db.txt"), verbose = False)
+        self.assertEqual(str_extract_many({"read": r"_(R\d)"}, db, processes = 2, chunkSize = 2)["read_1"].dropna().tolist(), ["R1", "R1"])
+        self.assertEqual(str_extract_many("(?i)S1_L001", paths)["(?i)S1_L001"].dropna().tolist(), ["S1_L001"])
+        both = str_extract_many({"run": r"Run(?P<id>\d+)", "sample": r"S(?P<id>\d+)_"}, paths)
+        self.assertEqual(both[["run_id", "sample_id"]].iloc[:2].values.tolist(), [["7", "1"], ["8", "22"]])
+        self.assertEqual(str_search_many({"fastq": "FASTQ", "sheet": "sheet"}, pd.Series(paths), caseSensitive = False).sum().tolist(), [2, 0])
+        self.assertEqual(str_search("Run7", [paths, paths], trim = False), [[paths[0], None, None]] * 2)
+        shutil.rmtree(os.path.dirname(db))
+
+
+    def test_searchFlatFileDB_patterns(self):
+        db = generateFlatFileDB(self.test_dir, os.path.join(tempfile.mkdtemp(), "db.txt"), verbose = False, trigramIndex = True)
+        fastqs = sorted([os.path.join(self.test_dir, "run1", "fastq", "S1_R1.fastq.gz"), os.path.join(self.test_dir, "run2", "S2_R1.fastq.gz")])
+        for kwargs in [{}, {"useIndex": False}, {"useIndex": False, "processes": 2}]:
+            self.assertEqual(sorted(searchFlatFileDB(db, searchTerms = r"S\d_R1\.fastq\.gz$", mode = "regex", verbose = False, **kwargs)), fastqs)
+            self.assertEqual(searchFlatFileDB(db, searchTerms = r"s\d_r1", excludeTerms = "run[2-9]", mode = "regex", verbose = False, **kwargs), fastqs[:1])
+            self.assertEqual(sorted(searchFlatFileDB(db, searchTerms = "*/S?_R1.fastq.gz", mode = "glob", caseSensitive = True, verbose = False, **kwargs)), fastqs)
+            self.assertEqual(searchFlatFileDB(db, searchTerms = "*.FASTQ", mode = "glob", caseSensitive = True, verbose = False, **kwargs), [])
+        with self.assertRaises(ValueError): searchFlatFileDB(db, searchTerms = "x", mode = "fuzzy", verbose = False)
+        shutil.rmtree(os.path.dirname(db))
+
+
+
+class TestAutomatonCache(unittest.TestCase):
+    """
+    Unit tests for the in-memory and on-disk automaton caches.
+    """
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.functions = sys.modules[generateSearchAutomaton.__module__]
+        self.patches = [mock.patch.object(self.functions, "AUTOMATON_CACHE_DIR", self.cache_dir), mock.patch.object(self.functions, "AUTOMATON_CACHE_MIN_SECONDS", 0)]
+        for patch in self.patches: patch.start()
+        clearAutomatonCache()
+
+    def tearDown(self):
+        clearAutomatonCache()
+        for patch in self.patches: patch.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def pickles(self):
+        return sorted(pathlib.Path(self.cache_dir, "automata").glob("*.pkl"))
+
+    def test_memoryHit(self):
+        automaton = generateSearchAutomaton(["S1", "S2"], cache = True)
+        self.assertIs(generateSearchAutomaton(["S1", "S2"], cache = True), automaton)
+        self.assertIsNot(generateSearchAutomaton(["S1", "S2"]), automaton)
+        self.assertIsNot(generateSearchAutomaton(["S1", "S2"], caseSensitive = True, cache = True), automaton)
+
+    def plant(self, file, terms):
+        """Replaces a cached pickle with an automaton of other terms, so a disk hit can be told apart from a rebuild."""
+        with open(file, "wb") as f: pickle.dump((1e9, generateSearchAutomaton(terms)), f)
+
+    def test_diskHit(self):
+        generateSearchAutomaton(["S1", "S2"], cache = True)
+        self.assertEqual(len(self.pickles()), 1)
+        self.plant(self.pickles()[0], ["planted"])
+        clearAutomatonCache()
+        automaton = generateSearchAutomaton(["S1", "S2"], cache = True)
+        self.assertEqual(list(automaton.keys()), ["planted"])
+
+    def test_diskSlowerThanBuild(self):
+        generateSearchAutomaton(["S1", "S2"], cache = True)
+        file = self.pickles()[0]
+        with open(file, "rb") as f: _, automaton = pickle.load(f)
+        with open(file, "wb") as f: pickle.dump((0, automaton), f) # Recorded as instant to build
+        clearAutomatonCache()
+        generateSearchAutomaton(["S1", "S2"], cache = True)
+        self.assertEqual(self.pickles(), [])
+
+    def test_sizeEviction(self):
+        generateSearchAutomaton(["S1", "S2"], cache = True)
+        size = self.pickles()[0].stat().st_size
+        os.utime(self.pickles()[0], (0, 0))
+        with mock.patch.object(self.functions, "AUTOMATON_CACHE_BYTES", int(size * 1.5)):
+            generateSearchAutomaton(["S3", "S4"], cache = True)
+        self.assertEqual(len(self.pickles()), 1)
+        self.plant(self.pickles()[0], ["planted"])
+        clearAutomatonCache()
+        self.assertEqual(list(generateSearchAutomaton(["S3", "S4"], cache = True).keys()), ["planted"])
+
+    def test_clearAutomatonCache(self):
+        automaton = generateSearchAutomaton(["S1", "S2"], cache = True)
+        clearAutomatonCache(disk = True)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "automata")))
+        self.assertIsNot(generateSearchAutomaton(["S1", "S2"], cache = True), automaton)
+
+
+if __name__ == "__main__":
+    unittest.main()